@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Benchmarks the deploy scripts against an in-process S3 stand-in
+
+Builds a synthetic game tree, deploys it with deploy_games and deploy_to_s3 and
+reports files/s, MB/s, the requests made and how long scanning and hashing took.
+Each tool is run twice: a cold deploy that uploads everything and a warm deploy
+of the same tree that should upload nothing.  deploy_games then deploys the tree
+with one directory moved, which should copy instead of upload, and with files
+renamed in a cycle, which must not copy from keys the same deploy overwrites.
+"""
+
+import logging  # logging
+import os  # Operating system functions
+import sys  # System functions
+import argparse  # parse args from the command line
+import subprocess  # makes system calls
+import hashlib  # Builds the ETags of objects put directly
+import threading  # Guards the stand-in shared by the upload workers
+import random  # Picks the file sizes
+import shutil  # Cleans up the synthetic tree
+import tempfile  # Holds the synthetic tree
+import time  # Times each run
+import io  # Holds the bodies the stand-in returns
+from copy import deepcopy  # Keeps copied objects apart
+
+try:
+    from botocore.exceptions import ClientError  # Raised when a request to AWS fails
+except ImportError:
+    print ('You are missing boto3.  run: pip install boto3')
+    sys.exit(1)
+
+import deploy_games  # Deploys games
+import deploy_hashing  # Builds the ETags of uploaded files
+import deploy_transfer  # Sizes of the multipart uploads
+import deploy_to_s3  # Deploys versioned builds
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# Number of files and the range of sizes in bytes for each shape of tree
+shapes = {
+    'tiny': [(2000, 200, 4 * 1024)],
+    'huge': [(4, 32 * 1024 * 1024, 64 * 1024 * 1024)],
+    'mixed': [(1000, 200, 16 * 1024), (100, 64 * 1024, 1024 * 1024), (2, 16 * 1024 * 1024, 32 * 1024 * 1024)]
+}
+
+extensions = ['js', 'css', 'html', 'json', 'png', 'mp3']
+
+
+class FakeS3(object):
+    """
+    Minimal in-process stand-in for the parts of the S3 API the deploy scripts use
+
+    Uploaded files are kept as their ETag and size only, so big trees do not
+    need the memory to hold them.  Every request is counted by operation.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.requests = {}
+        self.meta = self
+        self.client = self
+        self.events = self
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def Bucket(self, name):
+        return FakeBucket(self, name)
+
+    def reset_requests(self):
+        self.requests = {}
+
+    def register(self, event_name, handler):
+        self._handlers.setdefault(event_name.split('.')[0], []).append(handler)
+
+    def _count(self, operation):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+        # Every request takes and gives back a slot of the limiter like it would through botocore
+        for handler in self._handlers.get('before-send', []):
+            handler(request=None)
+
+        for handler in self._handlers.get('response-received', []):
+            handler(parsed_response={}, exception=None, context={})
+
+    def _put(self, bucket, key, etag, size, extra):
+        s3_object = dict(extra)
+        s3_object.update({'ETag': '"%s"' % etag, 'Size': size})
+        with self._lock:
+            self.buckets.setdefault(bucket, {})[key] = s3_object
+
+    def _get(self, bucket, key, operation):
+        s3_object = self.buckets.get(bucket, {}).get(key)
+        if s3_object is None:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, operation)
+
+        return s3_object
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        self._count('PutObject')
+        size = os.path.getsize(Filename)
+        etag = deploy_hashing.get_etag(Filename, Config.multipart_threshold, Config.multipart_chunksize)
+
+        self._put(Bucket, Key, etag, size, ExtraArgs or {})
+        if Callback is not None:
+            Callback(size)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._count('PutObject')
+        if not isinstance(Body, bytes):
+            Body = Body.encode('utf-8')
+
+        s3_object = dict(kwargs, Body=Body)
+        self._put(Bucket, Key, hashlib.md5(Body).hexdigest(), len(Body), s3_object)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._count('GetObject')
+        s3_object = deepcopy(self._get(Bucket, Key, 'GetObject'))
+        s3_object['Body'] = io.BytesIO(s3_object.get('Body', b''))
+        return s3_object
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._count('CopyObject')
+        s3_object = deepcopy(self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject'))
+        kwargs.pop('MetadataDirective', None)
+        s3_object.update(kwargs)
+        with self._lock:
+            self.buckets.setdefault(Bucket, {})[Key] = s3_object
+
+        return {'CopyObjectResult': {'ETag': s3_object['ETag']}}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count('HeadObject')
+        s3_object = dict(self._get(Bucket, Key, 'HeadObject'))
+        s3_object.pop('Body', None)
+        return s3_object
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        self.copy_object(Bucket=Bucket, Key=Key, CopySource=CopySource, **(ExtraArgs or {}))
+
+    def delete_object(self, Bucket, Key):
+        self._count('DeleteObject')
+        with self._lock:
+            self.buckets.get(Bucket, {}).pop(Key, None)
+
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._count('DeleteObjects')
+        with self._lock:
+            for delete_object in Delete['Objects']:
+                self.buckets.get(Bucket, {}).pop(delete_object['Key'], None)
+
+        return {'Deleted': Delete['Objects']}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self._count('ListObjectsV2')
+        with self._lock:
+            keys = sorted(key for key in self.buckets.get(Bucket, {}) if key.startswith(Prefix))
+
+        contents = []
+        common_prefixes = []
+        for key in keys:
+            if ContinuationToken is not None and key <= ContinuationToken:
+                continue
+
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+                continue
+
+            s3_object = self.buckets[Bucket][key]
+            contents.append({'Key': key, 'ETag': s3_object['ETag'], 'Size': s3_object['Size']})
+            if len(contents) >= MaxKeys:
+                return {'Contents': contents, 'IsTruncated': True, 'NextContinuationToken': key,
+                        'CommonPrefixes': [{'Prefix': prefix} for prefix in common_prefixes]}
+
+        return {'Contents': contents, 'IsTruncated': False,
+                'CommonPrefixes': [{'Prefix': prefix} for prefix in common_prefixes]}
+
+
+class FakeBucket(object):
+    """
+    Bucket resource for the stand-in
+    """
+
+    def __init__(self, fake_s3, name):
+        self.fake_s3 = fake_s3
+        self.name = name
+
+    def delete_objects(self, Delete):
+        return self.fake_s3.delete_objects(Bucket=self.name, Delete=Delete)
+
+
+def build_tree(root, shape, seed):
+    """
+    Writes a synthetic game tree of the shape in to root
+
+    :param root:
+    :param shape:
+    :param seed:
+    :return: tuple of the number of files and bytes written
+    """
+    chooser = random.Random(seed)
+    total_files = 0
+    total_bytes = 0
+    for file_count, min_size, max_size in shapes[shape]:
+        for file_number in range(file_count):
+            directory = os.path.join(root, 'level%s' % (total_files % 20), 'part%s' % (total_files % 7))
+            if os.path.isdir(directory) is False:
+                os.makedirs(directory)
+
+            size = chooser.randint(min_size, max_size)
+            file_name = os.path.join(directory, 'asset%s.%s' % (total_files, chooser.choice(extensions)))
+            with open(file_name, 'wb') as asset_file:
+                asset_file.write(os.urandom(size))
+
+            total_files += 1
+            total_bytes += size
+
+    return total_files, total_bytes
+
+
+def commit_tree(message):
+    """
+    Commits every change to the synthetic tree
+
+    :param message:
+    :return:
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['git', 'add', '-A', 'game'], stdout=devnull)
+        subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                               'commit', '-q', '-m', message], stdout=devnull)
+
+
+def check_deployed(fake_s3, bucket, file_names):
+    """
+    Exits when S3 does not have the local contents of the files
+
+    :param fake_s3:
+    :param bucket:
+    :param file_names:
+    :return:
+    """
+    for file_name in file_names:
+        local_etag = deploy_hashing.get_etag(file_name, deploy_transfer.MULTIPART_THRESHOLD,
+                                             deploy_transfer.MULTIPART_CHUNKSIZE)
+        remote_etag = fake_s3.buckets.get(bucket, {}).get(file_name, {}).get('ETag', '').strip('"')
+        if remote_etag != local_etag:
+            raise SystemExit('S3 has the wrong contents for %s: %s instead of %s' % (
+                file_name, remote_etag, local_etag))
+
+
+def run_deploy(fake_s3, deploy_class, argv):
+    """
+    Runs one deploy against the stand-in
+
+    :param fake_s3:
+    :param deploy_class:
+    :param argv:
+    :return: dict of what the run did and how long it took
+    """
+    fake_s3.reset_requests()
+    start_time = time.time()
+    deploy = deploy_class(argv)
+    elapsed = max(time.time() - start_time, 0.001)
+    report = deploy.metrics.report()
+    timers = dict(report['timers'])
+    counters = report['counters']
+    uploaded_files = counters.get('files_uploaded', 0)
+    uploaded_bytes = counters.get('bytes_uploaded', 0)
+    return {
+        'seconds': elapsed,
+        'files': uploaded_files,
+        'files_per_second': uploaded_files / elapsed,
+        'mb_per_second': uploaded_bytes / 1048576.0 / elapsed,
+        'requests': dict(fake_s3.requests),
+        'scan_seconds': timers.get('scan', 0.0),
+        'hash_seconds': timers.get('hash', 0.0)
+    }
+
+
+def log_result(tool, run, result):
+    """
+    Logs one row of results
+
+    :param tool:
+    :param run:
+    :param result:
+    :return:
+    """
+    requests = ', '.join('%s=%s' % (operation, count) for operation, count in sorted(result['requests'].items()))
+    logger.info('%-14s %-5s %8.2f %8s %10.1f %9.2f %8.3f %8.3f  %s' % (
+        tool, run, result['seconds'], result['files'], result['files_per_second'], result['mb_per_second'],
+        result['scan_seconds'], result['hash_seconds'], requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the deploy scripts against an in-process S3 stand-in')
+    parser.add_argument('--shape', help='Shape of the synthetic tree', choices=sorted(shapes.keys()), default='mixed')
+    parser.add_argument('--scale', help='Multiplies the number of files in the tree', type=float, default=1.0)
+    parser.add_argument('--tool', help='Deploy script to benchmark', choices=['games', 'to_s3', 'both'],
+                        default='both')
+    parser.add_argument('-j', '--jobs', help='Number of workers the deploy scripts use', type=int, default=8)
+    parser.add_argument('--seed', help='Seed for the file sizes', type=int, default=1)
+    parser.add_argument('--keep', help='Keep the synthetic tree', action='store_true')
+    parser.add_argument('-v', '--verbose', help='Show the logs of the deploy scripts', action='store_true')
+    args = parser.parse_args()
+
+    if args.scale != 1.0:
+        for shape_name in shapes:
+            shapes[shape_name] = [(max(1, int(file_count * args.scale)), min_size, max_size)
+                                  for file_count, min_size, max_size in shapes[shape_name]]
+
+    if args.verbose is False:
+        deploy_games.logger.setLevel(logging.WARNING)
+        deploy_to_s3.logger.setLevel(logging.WARNING)
+
+    fake_s3 = FakeS3()
+    deploy_games.boto3.resource = lambda *resource_args, **resource_kwargs: fake_s3
+    deploy_to_s3.boto3.resource = lambda *resource_args, **resource_kwargs: fake_s3
+
+    work_dir = tempfile.mkdtemp(prefix='deploy_bench_')
+    original_dir = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        logger.info('Building %s tree in %s' % (args.shape, work_dir))
+        total_files, total_bytes = build_tree(os.path.join(work_dir, 'game'), args.shape, args.seed)
+        logger.info('Built %s files (%.2f MB)' % (total_files, total_bytes / 1048576.0))
+
+        logger.info('%-14s %-5s %8s %8s %10s %9s %8s %8s  %s' % (
+            'tool', 'run', 'seconds', 'files', 'files/s', 'MB/s', 'scan', 'hash', 'requests'))
+        if args.tool in ['games', 'both']:
+            # deploy_games only deploys files git is tracking
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['git', 'init', '-q'], stdout=devnull)
+                subprocess.check_call(['git', 'add', 'game'], stdout=devnull)
+                subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                                       'commit', '-q', '-m', 'bench'], stdout=devnull)
+
+            games_argv = ['-g', 'game', '-e', 'qa', '--bucket', 'bench-games', '-j', str(args.jobs)]
+            for run in ['cold', 'warm']:
+                log_result('deploy_games', run, run_deploy(fake_s3, deploy_games.CMWNDeploy, games_argv))
+
+            # Moving a directory should copy its big files on S3 instead of uploading them again
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['git', 'mv', os.path.join('game', 'level0'), os.path.join('game', 'moved0')],
+                                      stdout=devnull)
+                subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                                       'commit', '-q', '-m', 'move'], stdout=devnull)
+
+            log_result('deploy_games', 'moved', run_deploy(fake_s3, deploy_games.CMWNDeploy, games_argv + ['-P']))
+
+            # Renaming files in a cycle leaves every key on S3 but each with the contents of another
+            cycle_files = [os.path.join('game', 'cycle', 'track%s.mp3' % track) for track in range(3)]
+            os.makedirs(os.path.join('game', 'cycle'))
+            for cycle_file, size in zip(cycle_files, [2, 2, 9]):
+                with open(cycle_file, 'wb') as asset_file:
+                    asset_file.write(os.urandom(size * 1024 * 1024))
+
+            commit_tree('cycle')
+            run_deploy(fake_s3, deploy_games.CMWNDeploy, games_argv)
+            os.rename(cycle_files[0], cycle_files[0] + '.tmp')
+            os.rename(cycle_files[1], cycle_files[0])
+            os.rename(cycle_files[2], cycle_files[1])
+            os.rename(cycle_files[0] + '.tmp', cycle_files[2])
+            commit_tree('rename cycle')
+            log_result('deploy_games', 'cycle', run_deploy(fake_s3, deploy_games.CMWNDeploy, games_argv))
+            check_deployed(fake_s3, 'bench-games', cycle_files)
+
+        if args.tool in ['to_s3', 'both']:
+            # A new version goes up every time, so the warm run uses the content addressed blobs
+            for run in ['cold', 'warm']:
+                to_s3_argv = ['-s', 'game', '--version', 'bench-%s' % run, '--bucket', 'bench-builds',
+                              '--content-addressed', '-j', str(args.jobs)]
+                log_result('deploy_to_s3', run, run_deploy(fake_s3, deploy_to_s3.CMWNDeploy, to_s3_argv))
+    finally:
+        os.chdir(original_dir)
+        if args.keep is False:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
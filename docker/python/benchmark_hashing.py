@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Benchmarks hashing files with deploy_hashing
+
+Builds a synthetic tree, hashes it with one file at a time read 10KB at a time
+(how the deploy scripts used to hash) and then with deploy_hashing on 1, 2, 4 ...
+up to every core, reporting MB/s and the speed up over the old way.
+"""
+
+import logging  # logging
+import os  # Operating system functions
+import argparse  # parse args from the command line
+import hashlib  # Hashes the baseline
+import multiprocessing  # Counts the cores
+import random  # Picks the file sizes
+import shutil  # Cleans up the synthetic tree
+import tempfile  # Holds the synthetic tree
+import time  # Times each run
+
+import deploy_hashing  # Hashes files on every core
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# Number of files and the range of sizes in bytes for each shape of tree
+shapes = {
+    'tiny': [(5000, 200, 4 * 1024)],
+    'huge': [(8, 32 * 1024 * 1024, 64 * 1024 * 1024)],
+    'mixed': [(2000, 200, 16 * 1024), (200, 64 * 1024, 1024 * 1024), (4, 16 * 1024 * 1024, 32 * 1024 * 1024)]
+}
+
+
+def build_tree(root, shape, seed):
+    """
+    Writes a synthetic tree of the shape in to root
+
+    :param root:
+    :param shape:
+    :param seed:
+    :return: tuple of the file names and bytes written
+    """
+    chooser = random.Random(seed)
+    file_names = []
+    total_bytes = 0
+    for file_count, min_size, max_size in shapes[shape]:
+        for file_number in range(file_count):
+            directory = os.path.join(root, 'dir%s' % (len(file_names) % 20))
+            if os.path.isdir(directory) is False:
+                os.makedirs(directory)
+
+            size = chooser.randint(min_size, max_size)
+            file_name = os.path.join(directory, 'file%s' % len(file_names))
+            with open(file_name, 'wb') as data_file:
+                data_file.write(os.urandom(size))
+
+            file_names.append(file_name)
+            total_bytes += size
+
+    return file_names, total_bytes
+
+
+def hash_baseline(file_names):
+    """
+    Hashes one file at a time reading 10KB at a time
+
+    :param file_names:
+    :return: dict of file name to hash
+    """
+    hashes = {}
+    for file_name in file_names:
+        md5 = hashlib.md5()
+        with open(file_name, 'rb') as read_file:
+            for chunk in iter(lambda: read_file.read(10240), b''):
+                md5.update(chunk)
+
+        hashes[file_name] = md5.hexdigest()
+
+    return hashes
+
+
+def get_process_counts(max_processes):
+    """
+    Gets 1, 2, 4 ... up to and including max_processes
+
+    :param max_processes:
+    :return:
+    """
+    process_counts = []
+    processes = 1
+    while processes < max_processes:
+        process_counts.append(processes)
+        processes *= 2
+
+    process_counts.append(max_processes)
+    return process_counts
+
+
+def time_run(run, repeat):
+    """
+    Gets the best time of a few runs
+
+    :param run:
+    :param repeat:
+    :return: tuple of the seconds and what the run returned
+    """
+    best = None
+    result = None
+    for attempt in range(repeat):
+        start_time = time.time()
+        result = run()
+        elapsed = max(time.time() - start_time, 0.001)
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hashing files with deploy_hashing')
+    parser.add_argument('--shape', help='Shape of the synthetic tree', choices=sorted(shapes.keys()), default='mixed')
+    parser.add_argument('--scale', help='Multiplies the number of files in the tree', type=float, default=1.0)
+    parser.add_argument('--max-processes', help='Most processes to hash with, defaults to one per core', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--repeat', help='Number of times each run is repeated, the best is kept', type=int,
+                        default=3)
+    parser.add_argument('--seed', help='Seed for the file sizes', type=int, default=1)
+    parser.add_argument('--keep', help='Keep the synthetic tree', action='store_true')
+    args = parser.parse_args()
+
+    if args.scale != 1.0:
+        for shape_name in shapes:
+            shapes[shape_name] = [(max(1, int(file_count * args.scale)), min_size, max_size)
+                                  for file_count, min_size, max_size in shapes[shape_name]]
+
+    work_dir = tempfile.mkdtemp(prefix='hash_bench_')
+    try:
+        logger.info('Building %s tree in %s' % (args.shape, work_dir))
+        file_names, total_bytes = build_tree(work_dir, args.shape, args.seed)
+        total_mb = total_bytes / 1048576.0
+        logger.info('Built %s files (%.2f MB), the page cache is warm for every run' % (len(file_names), total_mb))
+
+        baseline_seconds, baseline_hashes = time_run(lambda: hash_baseline(file_names), args.repeat)
+        logger.info('%-22s %8s %9s %8s' % ('run', 'seconds', 'MB/s', 'speed up'))
+        logger.info('%-22s %8.3f %9.2f %7.2fx' % ('baseline 10KB reads', baseline_seconds,
+                                                 total_mb / baseline_seconds, 1.0))
+
+        for processes in get_process_counts(max(1, args.max_processes)):
+            seconds, hashes = time_run(lambda: deploy_hashing.hash_files(file_names, processes), args.repeat)
+            if hashes != baseline_hashes:
+                raise SystemExit('Hashes from %s processes do not match the baseline' % processes)
+
+            logger.info('%-22s %8.3f %9.2f %7.2fx' % ('%s processes' % processes, seconds, total_mb / seconds,
+                                                     baseline_seconds / seconds))
+    finally:
+        if args.keep is False:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
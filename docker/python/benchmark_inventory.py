@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Benchmarks the S3 inventory against a dict of key to ETag
+
+Builds keys shaped like a bucket of games, then reports the memory each
+layout holds them in, how long it takes to build and how fast lookups and a
+full walk (what pruning does) run.
+"""
+
+import logging  # logging
+import argparse  # parse args from the command line
+import hashlib  # Makes the ETags
+import random  # Picks the keys to look up
+import sys  # Measures the memory used
+import time  # Times each step
+
+import deploy_inventory  # Compact map of the objects on S3
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+def build_items(key_count, seed):
+    """
+    Builds keys spread over games and directories like a games bucket
+
+    :param key_count:
+    :param seed:
+    :return: list of key, ETag, size and content type
+    """
+    chooser = random.Random(seed)
+    items = []
+    for key_number in range(key_count):
+        key = 'game%s/assets/level%s/part%s/asset-%s.png' % (key_number % 40, key_number % 50, key_number % 7,
+                                                            key_number)
+        etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+        if key_number % 500 == 0:
+            etag += '-%s' % chooser.randint(2, 20)
+
+        items.append((key, etag, chooser.randint(100, 1024 * 1024), 'image/png'))
+
+    return items
+
+
+def dict_size(objects):
+    """
+    Measures a dict of key to ETag with the strings it holds
+
+    :param objects:
+    :return:
+    """
+    return sys.getsizeof(objects) + sum(sys.getsizeof(key) + sys.getsizeof(etag) for key, etag in objects.items())
+
+
+def time_lookups(lookup, keys):
+    """
+    Times looking up every key
+
+    :param lookup: called with each key
+    :param keys:
+    :return: lookups per second
+    """
+    start_time = time.time()
+    for key in keys:
+        lookup(key)
+
+    return len(keys) / max(time.time() - start_time, 0.001)
+
+
+def time_walk(objects):
+    """
+    Times walking every key
+
+    :param objects:
+    :return: seconds
+    """
+    start_time = time.time()
+    for key in objects:
+        pass
+
+    return time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the S3 inventory against a dict of key to ETag')
+    parser.add_argument('--keys', help='Number of keys in the bucket', type=int, default=500000)
+    parser.add_argument('--lookups', help='Number of keys to look up', type=int, default=100000)
+    parser.add_argument('--seed', help='Seed for the keys', type=int, default=1)
+    args = parser.parse_args()
+
+    logger.info('Building %s keys' % args.keys)
+    items = build_items(args.keys, args.seed)
+    lookup_keys = [item[0] for item in random.Random(args.seed).sample(items, min(args.lookups, len(items)))]
+    lookup_keys += ['missing/%s' % key for key in lookup_keys[:len(lookup_keys) // 10]]
+
+    start_time = time.time()
+    objects = dict((key, etag) for key, etag, size, content_type in items)
+    dict_seconds = time.time() - start_time
+
+    start_time = time.time()
+    inventory = deploy_inventory.S3Inventory.from_items(items)
+    inventory_seconds = time.time() - start_time
+
+    logger.info('%-10s %10s %10s %8s %14s %8s' % ('layout', 'MB', 'bytes/key', 'build', 'lookups/s', 'walk'))
+    for layout, size, build_seconds, lookup, walked in [
+            ('dict', dict_size(objects), dict_seconds, objects.get, objects),
+            ('inventory', inventory.memory_size(), inventory_seconds, inventory.get_etag, inventory)]:
+        logger.info('%-10s %10.2f %10.1f %7.2fs %14.0f %7.2fs' % (
+            layout, size / 1048576.0, size / float(len(items)), build_seconds, time_lookups(lookup, lookup_keys),
+            time_walk(walked)))
+
+
+if __name__ == '__main__':
+    main()
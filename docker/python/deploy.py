@@ -15,6 +15,12 @@ except ImportError:
     print ('You are missing boto3.  run: pip install boto3')
     sys.exit(1)
 
+try:
+    from concurrent.futures import ThreadPoolExecutor  # Sends the deploys for several targets at once
+except ImportError:
+    print ('You are missing futures.  run: pip install futures')
+    sys.exit(1)
+
 try:
     import colorlog  # makes the logs nice and colorful in the console
 
@@ -39,6 +45,14 @@ class CmwDeploy:
         self.valid_env = ['qa', 'staging', 'production', 'demo', 'lab']
         self.deploy_target = None
 
+        # Seconds between checks on a running command, doubled after each quiet check
+        self.poll_start = 0.5
+        self.poll_max = 15.0
+        self.running_statuses = ['Pending', 'InProgress', 'Delayed', 'Cancelling']
+        # get_command_invocation cuts the output off at these lengths, the rest is only in the S3 output
+        self.output_limits = {'StandardOutputContent': 24000, 'StandardErrorContent': 8000}
+        self.output_urls = {'StandardOutputContent': 'StandardOutputUrl', 'StandardErrorContent': 'StandardErrorUrl'}
+
         default_ami = os.getenv('AWS_BASE_AMI')
         if default_ami is None:
             default_ami = 'ami-c481fad3'  # Base Amazon AMI
@@ -46,8 +60,13 @@ class CmwDeploy:
         # load in arguments
         parser = argparse.ArgumentParser(description='Deploys skribble to to environment', prog='deploy')
         parser.add_argument('version', help='The version to deploy')
-        parser.add_argument('app', help='Which app to deploy')
-        parser.add_argument('env', help='Where to deploy the application')
+        parser.add_argument('app', help='Which app to deploy', nargs='?')
+        parser.add_argument('env', help='Where to deploy the application', nargs='?')
+        parser.add_argument('--deploy', help='Also deploy this APP:ENV, can be repeated', action='append', default=[],
+                            metavar='APP:ENV')
+        parser.add_argument('--max-parallel', help='Number of deploys to run at the same time', type=int, default=4)
+        parser.add_argument('--timeout', help='Minutes to wait for each deploy command before giving up', type=float,
+                            default=60)
         parser.add_argument('-t', '--target', help='run the deploy to target instance')
         parser.add_argument('-k', '--keep', help='Leave the instance running', action='store_true')
         parser.add_argument('--ami', help='AMI to use when creating instance', default=default_ami)
@@ -58,6 +77,7 @@ class CmwDeploy:
         parser.add_argument('-v', '--verbose', help='Turn on debugging logging', action='store_true')
 
         self.args = parser.parse_args()
+        self.targets = self.get_targets(parser)
 
         try:
             if self.args.verbose:
@@ -70,7 +90,7 @@ class CmwDeploy:
                 self.logger.error('Bastion is missing')
                 sys.exit(128)
 
-            self.send_command()
+            self.deploy_targets()
         except (KeyboardInterrupt, SystemExit):
             self.logger.info('Exit')
             sys.exit(1)
@@ -103,9 +123,76 @@ class CmwDeploy:
 
         return instance.id
 
-    def send_command(self):
-        """Sends the SSM command to bastion"""
-        self.logger.info('Sending deploy command')
+    def get_targets(self, parser):
+        """Gets the list of (app, env) pairs to deploy"""
+        targets = []
+        if self.args.app is not None or self.args.env is not None:
+            if self.args.app is None or self.args.env is None:
+                parser.error('app and env must be given together')
+
+            targets.append((self.args.app, self.args.env))
+
+        for deploy_target in self.args.deploy:
+            if deploy_target.count(':') != 1:
+                parser.error('--deploy must be APP:ENV not %s' % deploy_target)
+
+            targets.append(tuple(deploy_target.split(':')))
+
+        if len(targets) < 1:
+            parser.error('Nothing to deploy, pass an app and env or --deploy APP:ENV')
+
+        for app, env in targets:
+            if app not in self.valid_applications:
+                parser.error('Invalid app %s, choose from %s' % (app, ', '.join(self.valid_applications)))
+
+            if env not in self.valid_env:
+                parser.error('Invalid env %s, choose from %s' % (env, ', '.join(self.valid_env)))
+
+        if self.args.max_parallel < 1:
+            parser.error('--max-parallel must be at least 1')
+
+        if self.args.timeout <= 0:
+            parser.error('--timeout must be more than 0')
+
+        return targets
+
+    def deploy_targets(self):
+        """Deploys every target, several at a time, then logs a summary
+
+        Exits with 16 if any of the deploys failed
+        """
+        with ThreadPoolExecutor(max_workers=self.args.max_parallel) as executor:
+            results = list(executor.map(self.deploy_target, self.targets))
+
+        if len(results) > 1:
+            self.logger.info('%-8s %-12s %-12s %9s %s' % ('App', 'Env', 'Status', 'Seconds', 'Exit code'))
+            for app, env, status, response_code, seconds in results:
+                self.logger.info('%-8s %-12s %-12s %9.1f %s' % (app, env, status, seconds, response_code))
+
+        failed = [result for result in results if result[2] != 'Success']
+        if len(failed) > 0:
+            self.logger.error('%s of %s deploys failed' % (len(failed), len(results)))
+            sys.exit(16)
+
+    def deploy_target(self, target):
+        """Deploys one (app, env) pair and returns how it went"""
+        app, env = target
+        start_time = time.time()
+        try:
+            invocation = self.send_command(app, env)
+        except Exception as error:
+            self.logger.error('[%s/%s] Could not deploy: %s' % (app, env, error))
+            invocation = {'Status': 'Error'}
+
+        if invocation['Status'] != 'Success':
+            self.logger.error('[%s/%s] Command failed with status: %s (exit code %s)' % (
+                app, env, invocation['Status'], invocation.get('ResponseCode')))
+
+        return app, env, invocation['Status'], invocation.get('ResponseCode'), time.time() - start_time
+
+    def send_command(self, app, env):
+        """Sends the SSM command to bastion and waits for it to finish"""
+        self.logger.info('[%s/%s] Sending deploy command' % (app, env))
         command = self.ssm.send_command(
             InstanceIds=[
                 self.bastion_id,
@@ -117,27 +204,87 @@ class CmwDeploy:
                     self.args.version,
                 ],
                 'application': [
-                    self.args.app
+                    app
                 ],
                 'env': [
-                    self.args.env
+                    env
                 ]
             },
             OutputS3BucketName='cmwn-logs',
-            OutputS3KeyPrefix=('deploy/%s' % self.args.app),
+            OutputS3KeyPrefix=('deploy/%s' % app),
         )
 
-        self.logger.debug('Command Id: %s' % command['Command']['CommandId'])
-        self.logger.info('Waiting for command to complete')
-        status = 'Pending'
-        while status == 'Pending' or status == 'InProgress':
-            time.sleep(3)
-            status = (self.ssm.list_commands(CommandId=command['Command']['CommandId']))['Commands'][0]['Status']
-            self.logger.debug('Current command status: %s' % status)
+        command_id = command['Command']['CommandId']
+        self.logger.debug('[%s/%s] Command Id: %s' % (app, env, command_id))
+        self.logger.info('[%s/%s] Waiting for command to complete' % (app, env))
+        return self.wait_for_command(command_id, self.bastion_id, '[%s/%s] ' % (app, env))
 
-        if status != 'Success':
-            self.logger.error('Command failed with status: %s' % status)
-            sys.exit(16)
+    def wait_for_command(self, command_id, instance_id, label=''):
+        """Waits for the command to finish on the instance, logging its output as it runs
+
+        Checks start out quick so short commands return right away and back off
+        while the command is quiet so long commands make fewer calls.  A command
+        still running after --timeout minutes is cancelled and reported as TimedOut
+        """
+        interval = self.poll_start
+        seen = {'StandardOutputContent': 0, 'StandardErrorContent': 0, 'truncated': []}
+        deadline = time.time() + self.args.timeout * 60
+        while True:
+            if time.time() > deadline:
+                self.logger.error('%sGave up on command %s after %s minutes' % (label, command_id, self.args.timeout))
+                try:
+                    self.ssm.cancel_command(CommandId=command_id, InstanceIds=[instance_id])
+                except Exception as error:
+                    self.logger.warn('%sCould not cancel command %s: %s' % (label, command_id, error))
+
+                return {'Status': 'TimedOut'}
+
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+            try:
+                invocation = self.ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+            except self.ssm.exceptions.InvocationDoesNotExist:
+                # The invocation takes a moment to show up after the command is sent
+                invocation = {'Status': 'Pending'}
+
+            status = invocation['Status']
+            self.logger.debug('%sCurrent command status: %s' % (label, status))
+            finished = status not in self.running_statuses
+            new_output = self.log_output(invocation, seen, finished, label)
+            if finished:
+                return invocation
+
+            if new_output is False:
+                interval = min(interval * 2, self.poll_max)
+
+    def log_output(self, invocation, seen, finished, label=''):
+        """Logs the output the command wrote since the last check
+
+        Only whole lines are logged while the command runs, what is left is logged when it finishes.
+        Once the output reaches the length get_command_invocation cuts it off at,
+        a warning points to the full output on S3
+        """
+        new_output = False
+        for stream, log in [('StandardOutputContent', self.logger.info), ('StandardErrorContent', self.logger.warn)]:
+            output = invocation.get(stream, '')[seen[stream]:]
+            if finished is False:
+                output = output[:output.rfind('\n') + 1]
+
+            if len(output) < 1:
+                continue
+
+            for line in output.splitlines():
+                log(label + line)
+
+            seen[stream] += len(output)
+            new_output = True
+
+        for stream, limit in self.output_limits.items():
+            if len(invocation.get(stream, '')) >= limit and stream not in seen['truncated']:
+                seen['truncated'].append(stream)
+                self.logger.warn('%sOutput is cut off after %s characters, the full output is at %s' % (
+                    label, limit, invocation.get(self.output_urls[stream]) or 's3://cmwn-logs/deploy/'))
+
+        return new_output
 
     def mk_logger(self):
         """Creates a logger"""
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+How the deploy scripts serve each asset
+
+Works out the mime type and Cache-Control S3 sends with each file and
+compresses the text like ones
+"""
+
+import fnmatch  # Matches cache rules to paths
+import gzip  # Compresses text assets
+import io  # Buffers compressed data
+import json  # Reads the cache rules file
+import os  # Splits the extension off file names
+import re  # Spots content hashes in file names
+import sys  # Finds libmagic on windows
+import threading  # Guards the libmagic cache shared by the upload workers
+
+try:
+    import magic  # Mime type detector
+except ImportError:
+    print ('You are missing magic.')
+    print ('to fix run: brew install libmagic')
+    print ('then: pip install python-magic')
+    sys.exit(1)
+
+try:
+    from concurrent.futures import ProcessPoolExecutor  # Worker processes for compression
+except ImportError:
+    print ('You are missing futures.  run: pip install futures')
+    sys.exit(1)
+
+try:
+    import brotli  # Optional brotli compression
+
+    have_brotli = True
+except ImportError:
+    have_brotli = False
+
+# Extension to mime type, checked before falling back to libmagic
+MIME_MAPS = {
+    'html': 'text/html',
+    'htm': 'text/html',
+    'css': 'text/css',
+    'js': 'application/javascript',
+    'js.map': 'application/javascript',
+    'mjs': 'application/javascript',
+    'json': 'application/json',
+    'map': 'application/json',
+    'webmanifest': 'application/manifest+json',
+    'xml': 'application/xml',
+    'txt': 'text/plain',
+    'csv': 'text/csv',
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'ico': 'image/x-icon',
+    'bmp': 'image/bmp',
+    'mp3': 'audio/mpeg',
+    'ogg': 'audio/ogg',
+    'oga': 'audio/ogg',
+    'wav': 'audio/wav',
+    'm4a': 'audio/mp4',
+    'aac': 'audio/aac',
+    'mp4': 'video/mp4',
+    'm4v': 'video/mp4',
+    'webm': 'video/webm',
+    'ogv': 'video/ogg',
+    'woff': 'font/woff',
+    'woff2': 'font/woff2',
+    'ttf': 'font/ttf',
+    'otf': 'font/otf',
+    'eot': 'application/vnd.ms-fontobject',
+    'wasm': 'application/wasm',
+    'pdf': 'application/pdf',
+    'zip': 'application/zip'
+}
+
+# Only text like assets are worth compressing
+COMPRESS_MIMES = [
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml'
+]
+
+# Names like app.3f9a1c.js or vendor-3f9a1c2b.css carry a hash of their content
+HASHED_NAME_PATTERN = re.compile(r'[.\-_]([0-9a-f]{6,})(?=\.)', re.IGNORECASE)
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Entry points and manifests must be checked on every load so new hashed names are picked up
+DEFAULT_CACHE_RULES = [
+    ('*.html', 'no-cache'),
+    ('*.htm', 'no-cache'),
+    ('*manifest.json', 'no-cache'),
+    ('*.webmanifest', 'no-cache')
+]
+
+
+def compress_file(compress_job):
+    """
+    Compresses a file in to the compressed cache, run in a worker process
+
+    gzip output is written with out a timestamp so the same source always gives
+    the same bytes (and the same ETag on S3)
+
+    :param compress_job: tuple of the source file, compressed file and encoding
+    :return:
+    """
+    source_file, compressed_file, encoding = compress_job
+    read_file = open(source_file, 'rb')
+    data = read_file.read()
+    read_file.close()
+
+    if encoding == 'br':
+        compressed = brotli.compress(data)
+    else:
+        gzip_buffer = io.BytesIO()
+        gzip_file = gzip.GzipFile(fileobj=gzip_buffer, mode='wb', compresslevel=9, mtime=0)
+        gzip_file.write(data)
+        gzip_file.close()
+        compressed = gzip_buffer.getvalue()
+
+    # Written under a temp name so an interrupted deploy never leaves a partial file in the cache
+    temp_file_name = '%s.%s.tmp' % (compressed_file, os.getpid())
+    write_file = open(temp_file_name, 'wb')
+    write_file.write(compressed)
+    write_file.close()
+    os.rename(temp_file_name, compressed_file)
+
+
+class Compressor(object):
+    """
+    Compresses the text like files to deploy and picks the file each upload sends
+
+    Compressed files are cached by the hash of their source so unchanged files
+    are not compressed again on the next deploy
+    """
+
+    def __init__(self, encoding, cache_dir, min_saving, mime_detector, logger):
+        self.encoding = encoding
+        self.cache_dir = cache_dir
+        self.min_saving = min_saving
+        self.mime_detector = mime_detector
+        self.logger = logger
+        self.compressed_files = {}
+
+    def compress_files(self, source_files, hash_files):
+        """
+        Compresses the text like files using a pool of worker processes
+
+        :param source_files:
+        :param hash_files: called with a list of files, returns a dict of each file to its hash
+        :return:
+        """
+        if os.path.isdir(self.cache_dir) is False:
+            os.makedirs(self.cache_dir)
+
+        source_files = [source_file for source_file in source_files
+                        if os.path.isfile(source_file) is True
+                        and self.mime_detector.get_mime(source_file) in COMPRESS_MIMES]
+        source_hashes = hash_files(source_files)
+        compress_jobs = []
+        for source_file in source_files:
+            compressed_file = os.path.join(self.cache_dir, '%s.%s' % (source_hashes[source_file], self.encoding))
+            self.compressed_files[source_file] = compressed_file
+            if os.path.isfile(compressed_file) is False:
+                compress_jobs.append((source_file, compressed_file, self.encoding))
+
+        self.logger.info('Compressing %s of %s files with %s' % (len(compress_jobs), len(self.compressed_files),
+                                                                 self.encoding))
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(compress_file, compress_jobs))
+
+    def get_upload_file(self, source_file):
+        """
+        Gets the file to upload in place of the source and its content encoding
+
+        The compressed file is only used when it saves enough over the source
+
+        :param source_file:
+        :return: tuple of the file to upload and the content encoding or None
+        """
+        if source_file not in self.compressed_files:
+            return source_file, None
+
+        compressed_file = self.compressed_files[source_file]
+        source_size = os.path.getsize(source_file)
+        if os.path.getsize(compressed_file) > source_size * (100 - self.min_saving) / 100.0:
+            self.logger.debug('Compressing %s does not save enough' % source_file)
+            return source_file, None
+
+        return compressed_file, self.encoding
+
+
+class MimeDetector(object):
+    """
+    Gets the mime type of files
+
+    Known extensions are looked up in MIME_MAPS.  Anything else is sniffed with
+    libmagic once per extension.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._mime_cache = {}
+        self._mime_lock = threading.Lock()
+
+    def get_mime(self, source_file):
+        """
+        Gets the mime type of a file
+
+        :param source_file:
+        :return:
+        """
+        name_parts = os.path.basename(source_file).lower().split('.')[1:]
+        extensions = ['.'.join(name_parts[-2:]), name_parts[-1]] if len(name_parts) > 0 else []
+        for extension in extensions:
+            if extension in MIME_MAPS:
+                return MIME_MAPS[extension]
+
+        extension = extensions[-1] if len(extensions) > 0 else None
+        with self._mime_lock:
+            if extension in self._mime_cache:
+                return self._mime_cache[extension]
+
+        if (sys.platform == 'win32'):
+            m = magic.Magic(magic_file='C:\Program Files (x86)\GnuWin32\share\misc\magic', mime=True)
+            source_mime = m.from_file(source_file)
+        else:
+            source_mime = magic.from_file(source_file, mime=True)
+
+        self.logger.debug('libmagic detected %s as %s' % (source_file, source_mime))
+        if extension is not None:
+            with self._mime_lock:
+                self._mime_cache[extension] = source_mime
+
+        return source_mime
+
+
+class CachePolicy(object):
+    """
+    Picks the Cache-Control for each path
+
+    The first matching rule wins, then content hashed names are cached forever,
+    then DEFAULT_CACHE_RULES and finally the cache time
+    """
+
+    def __init__(self, cache_time, cli_rules, rules_file, logger):
+        """
+        :param cache_time: max-age in seconds for paths nothing else matches
+        :param cli_rules: list of GLOB=CACHE_CONTROL strings
+        :param rules_file: JSON file with a list of {"pattern": ..., "cache_control": ...}
+        :param logger:
+        """
+        self.cache_time = cache_time
+        self.cache_rules = self.load_rules(cli_rules, rules_file)
+        logger.debug('Cache rules: %s' % self.cache_rules)
+
+    @staticmethod
+    def load_rules(cli_rules, rules_file):
+        """
+        Builds the ordered list of glob to Cache-Control rules
+
+        Rules from the command line come first, then the rules file
+
+        :param cli_rules: list of GLOB=CACHE_CONTROL strings
+        :param rules_file: JSON file with a list of {"pattern": ..., "cache_control": ...}
+        :return:
+        """
+        cache_rules = []
+        for cli_rule in cli_rules:
+            if '=' not in cli_rule:
+                raise SystemExit('Cache rule %s must look like GLOB=CACHE_CONTROL' % cli_rule)
+
+            pattern, cache_control = cli_rule.split('=', 1)
+            cache_rules.append((pattern, cache_control))
+
+        if rules_file is not None:
+            try:
+                with open(rules_file, 'r') as read_file:
+                    file_rules = json.load(read_file)
+
+                cache_rules += [(file_rule['pattern'], file_rule['cache_control']) for file_rule in file_rules]
+            except (IOError, ValueError, KeyError, TypeError) as error:
+                raise SystemExit('Cannot read cache rules from %s: %s' % (rules_file, error))
+
+        return cache_rules
+
+    def get_cache_control(self, path):
+        """
+        Gets the Cache-Control for a path
+
+        :param path:
+        :return:
+        """
+        for pattern, cache_control in self.cache_rules:
+            if fnmatch.fnmatch(path, pattern):
+                return cache_control
+
+        for hashed_name in HASHED_NAME_PATTERN.findall(os.path.basename(path)):
+            # Needs letters and digits so frame numbers and words are not treated as hashes
+            if re.search('[0-9]', hashed_name) and re.search('[a-fA-F]', hashed_name):
+                return IMMUTABLE_CACHE_CONTROL
+
+        for pattern, cache_control in DEFAULT_CACHE_RULES:
+            if fnmatch.fnmatch(path, pattern):
+                return cache_control
+
+        return 'max-age=%s' % self.cache_time
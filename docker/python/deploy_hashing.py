@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Hashes local files for the deploy scripts
+
+Files are read with a large reused buffer and spread across a pool of worker
+processes so every core is used.  Small files are sent to the workers in
+batches so the cost of passing work between processes stays low.
+"""
+
+import hashlib  # used to compare files
+import os  # Operating system functions
+
+try:
+    from concurrent.futures import ProcessPoolExecutor  # Worker processes for hashing
+except ImportError:
+    raise SystemExit('You are missing futures.  run: pip install futures')
+
+# Files are read this much at a time in to a buffer that is reused
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Small files are sent to the workers in batches of up to this many files or bytes
+BATCH_FILES = 256
+BATCH_BYTES = 16 * 1024 * 1024
+
+# Starting worker processes costs more than hashing this much in the current process
+POOL_MIN_BYTES = 32 * 1024 * 1024
+
+
+def get_etag(filename, multipart_threshold, multipart_chunksize):
+    """
+    Gets the ETag S3 reports for a file
+
+    Files uploaded in parts get the MD5 of all the part digests followed by the
+    number of parts instead of the MD5 of the file.  With out a threshold this is
+    the MD5 of the file.
+
+    :param filename:
+    :param multipart_threshold: size files are uploaded in parts at, None for the MD5
+    :param multipart_chunksize:
+    :return:
+    """
+    size = os.path.getsize(filename)
+    multipart = multipart_threshold is not None and size >= multipart_threshold
+    buffer_size = HASH_BUFFER_SIZE
+    if multipart is True and multipart_chunksize % HASH_BUFFER_SIZE != 0:
+        # Every read has to stay inside one part
+        buffer_size = multipart_chunksize
+
+    # Small files do not need the whole buffer
+    buffer = bytearray(max(1, min(buffer_size, size)))
+    view = memoryview(buffer)
+    md5 = hashlib.md5()
+    part_digests = []
+    part_read = 0
+    with open(filename, 'rb') as read_file:
+        while True:
+            read = read_file.readinto(buffer)
+            if not read:
+                break
+
+            md5.update(view[:read])
+            part_read += read
+            if multipart is True and part_read >= multipart_chunksize:
+                part_digests.append(md5.digest())
+                md5 = hashlib.md5()
+                part_read = 0
+
+    if multipart is False:
+        return md5.hexdigest()
+
+    if part_read > 0:
+        part_digests.append(md5.digest())
+
+    return '%s-%s' % (hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def hash_batch(hash_job):
+    """
+    Hashes a batch of files, run in a worker process
+
+    :param hash_job: tuple of the file names, multipart threshold and chunk size
+    :return: list of file name and hash pairs
+    """
+    file_names, multipart_threshold, multipart_chunksize = hash_job
+    return [(file_name, get_etag(file_name, multipart_threshold, multipart_chunksize)) for file_name in file_names]
+
+
+def make_batches(file_names):
+    """
+    Groups small files in to batches, big files get a batch of their own
+
+    :param file_names:
+    :return: list of (batch of file names, bytes in the batch)
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for file_name in file_names:
+        size = os.path.getsize(file_name)
+        if size >= BATCH_BYTES:
+            batches.append(([file_name], size))
+            continue
+
+        batch.append(file_name)
+        batch_bytes += size
+        if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+            batches.append((batch, batch_bytes))
+            batch = []
+            batch_bytes = 0
+
+    if len(batch) > 0:
+        batches.append((batch, batch_bytes))
+
+    return batches
+
+
+def hash_files(file_names, processes=None, multipart_threshold=None, multipart_chunksize=None):
+    """
+    Hashes files using a pool of worker processes
+
+    :param file_names:
+    :param processes: number of worker processes, defaults to the number of cores
+    :param multipart_threshold: pass with the chunk size to get S3 ETags instead of MD5s
+    :param multipart_chunksize:
+    :return: dict of file name to hash
+    """
+    batches = make_batches(file_names)
+    total_bytes = sum(batch_bytes for batch, batch_bytes in batches)
+    hash_jobs = [(batch, multipart_threshold, multipart_chunksize) for batch, batch_bytes in batches]
+    if processes == 1 or len(hash_jobs) < 2 or total_bytes < POOL_MIN_BYTES:
+        return dict(file_hash for hash_job in hash_jobs for file_hash in hash_batch(hash_job))
+
+    # Start the biggest batches first so one big file does not finish the run on its own
+    order = sorted(range(len(hash_jobs)), key=lambda index: batches[index][1], reverse=True)
+    hashes = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for file_hashes in executor.map(hash_batch, [hash_jobs[index] for index in order]):
+            hashes.update(file_hashes)
+
+    return hashes
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+"""
+Compact inventory of the objects in a bucket
+
+A dict of key to ETag string costs a few hundred bytes per object, which at
+millions of keys is gigabytes.  The inventory interns the "directory" of each
+key, packs the rest of the keys in to one buffer and keeps each ETag as its
+16 byte digest.  Lookups are a binary search over the sorted keys.
+
+Objects are packed as they are added to an InventoryBuilder, so the listing
+of a bucket goes page by page in to the inventory with out ever being held as
+a list of tuples.
+"""
+
+import binascii  # Packs ETags in to their digests
+import sys  # Measures the memory used
+import threading  # Guards building the index of ETags
+from array import array  # Packed columns of numbers
+from bisect import bisect_left, bisect_right  # Finds the directory of a key
+
+# Keys come back as text on python 3 and as bytes on python 2
+text_is_bytes = str is bytes
+
+# Objects go up to 5TB so sizes need 64 bits.  'L' is only 32 bits on windows and python 2 has no 'Q',
+# there a double is used, which holds every size up to 8PB exactly
+if text_is_bytes is False:
+    SIZE_TYPECODE = 'Q'
+elif array('L').itemsize >= 8:
+    SIZE_TYPECODE = 'L'
+else:
+    SIZE_TYPECODE = 'd'
+
+
+def encode_key(key):
+    """
+    Gets the UTF-8 bytes of a key, which sort in the same order as the key
+
+    :param key:
+    :return:
+    """
+    if isinstance(key, bytes):
+        return key
+
+    return key.encode('utf-8')
+
+
+def decode_key(key):
+    """
+    Gets a key back from its UTF-8 bytes
+
+    :param key:
+    :return:
+    """
+    if text_is_bytes is True:
+        return key
+
+    return key.decode('utf-8')
+
+
+def pack_etag(etag):
+    """
+    Splits an ETag in to its digest and the number of parts
+
+    :param etag: MD5 hex digest, optionally followed by - and the number of parts
+    :return: tuple of the 16 byte digest and the parts (0 when not multipart) or None if it is not an MD5
+    """
+    digest, dash, parts = etag.partition('-')
+    if len(digest) != 32 or (dash != '' and parts.isdigit() is False):
+        return None
+
+    try:
+        return binascii.unhexlify(digest), int(parts) if dash != '' else 0
+    except (TypeError, ValueError):
+        return None
+
+
+def unpack_etag(digest, parts):
+    """
+    Builds the ETag back from its digest and number of parts
+
+    :param digest:
+    :param parts:
+    :return:
+    """
+    etag = binascii.hexlify(digest).decode('ascii')
+    if parts == 0:
+        return etag
+
+    return '%s-%s' % (etag, parts)
+
+
+class S3Inventory(object):
+    """
+    Read only map of key to ETag, size and content type
+
+    Keys are grouped by "directory".  Each directory is stored once, the names
+    under it are packed in to one buffer sorted with in their directory.  ETags
+    that are not MD5s (like objects encrypted with KMS) are kept as strings.
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._dir_starts = array('I', [0])
+        self._names = b''
+        self._name_ends = array('I')
+        self._digests = b''
+        # S3 allows up to 10000 parts
+        self._parts = array('H')
+        self._sizes = array(SIZE_TYPECODE)
+        self._content_types = [None]
+        self._content_type_ids = array('H')
+        self._odd_etags = {}
+        # Indexes sorted by ETag, only built when something looks up a key by its ETag
+        self._etag_order = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Builds the inventory
+
+        :param items: iterable of key, ETag, size and content type, a key seen twice keeps the last one
+        :return:
+        """
+        builder = InventoryBuilder()
+        builder.add_items(items)
+        return builder.build()
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        for index, key in self._iter_keys():
+            yield key
+
+    def get_etag(self, key):
+        """
+        Gets the ETag of a key
+
+        :param key:
+        :return: the ETag or None when the key is not in the inventory
+        """
+        index = self._find(key)
+        if index is None:
+            return None
+
+        return self._get_etag(index)
+
+    def find_etag(self, etag):
+        """
+        Finds a key holding an object with this ETag
+
+        :param etag:
+        :return: the first key in the order of the inventory (by directory, then name) or None when no object has
+            the ETag
+        """
+        packed_etag = pack_etag(etag)
+        if packed_etag is None:
+            return None
+
+        etag_order = self._get_etag_order()
+        low = 0
+        high = len(etag_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_packed_etag(etag_order[middle]) < packed_etag:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(etag_order) and self._get_packed_etag(etag_order[low]) == packed_etag:
+            return self._get_key(etag_order[low])
+
+        return None
+
+    def items(self):
+        """
+        Yields every object grouped by directory, in name order with in each directory
+
+        :return: generator of key, ETag, size and content type
+        """
+        for index, key in self._iter_keys():
+            content_type = self._content_types[self._content_type_ids[index]]
+            yield key, self._get_etag(index), int(self._sizes[index]), content_type
+
+    def memory_size(self):
+        """
+        Measures the bytes used to hold the inventory
+
+        :return:
+        """
+        columns = [self._dir_starts, self._name_ends, self._parts, self._sizes, self._content_type_ids]
+        if self._etag_order is not None:
+            columns.append(self._etag_order)
+
+        size = sys.getsizeof(self._names) + sys.getsizeof(self._digests)
+        size += sum(column.buffer_info()[1] * column.itemsize for column in columns)
+        size += sys.getsizeof(self._dirs) + sum(sys.getsizeof(directory) for directory in self._dirs)
+        size += sys.getsizeof(self._odd_etags) + sum(sys.getsizeof(etag) for etag in self._odd_etags.values())
+        return size
+
+    def _find(self, key):
+        """
+        Finds the index of a key
+
+        :param key:
+        :return: the index or None when the key is not in the inventory
+        """
+        encoded_key = encode_key(key)
+        split = encoded_key.rfind(b'/') + 1
+        directory = encoded_key[:split]
+        dir_index = bisect_left(self._dirs, directory)
+        if dir_index >= len(self._dirs) or self._dirs[dir_index] != directory:
+            return None
+
+        name = encoded_key[split:]
+        low = self._dir_starts[dir_index]
+        high = self._dir_starts[dir_index + 1]
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._dir_starts[dir_index + 1] and self._get_name(low) == name:
+            return low
+
+        return None
+
+    def _iter_keys(self):
+        """
+        Yields the index and key of every object in the order of the inventory
+
+        :return:
+        """
+        for dir_index, directory in enumerate(self._dirs):
+            for index in range(self._dir_starts[dir_index], self._dir_starts[dir_index + 1]):
+                yield index, decode_key(directory + self._get_name(index))
+
+    def _get_etag_order(self):
+        """
+        Gets the indexes of the objects sorted by ETag, building them the first time
+
+        Objects with ETags that are not MD5s are left out.  Equal ETags stay in the
+        order of the inventory since the sort is stable.
+
+        :return:
+        """
+        with self._lock:
+            if self._etag_order is None:
+                self._etag_order = array('I', sorted((index for index in range(len(self))
+                                                      if index not in self._odd_etags), key=self._get_packed_etag))
+
+            return self._etag_order
+
+    def _get_packed_etag(self, index):
+        """
+        Gets the digest and number of parts at an index
+
+        :param index:
+        :return:
+        """
+        return self._digests[index * 16:index * 16 + 16], self._parts[index]
+
+    def _get_key(self, index):
+        """
+        Gets the key at an index
+
+        :param index:
+        :return:
+        """
+        dir_index = bisect_right(self._dir_starts, index) - 1
+        return decode_key(self._dirs[dir_index] + self._get_name(index))
+
+    def _get_name(self, index):
+        """
+        Gets the name (the key with out its directory) at an index
+
+        :param index:
+        :return:
+        """
+        start = self._name_ends[index - 1] if index > 0 else 0
+        return self._names[start:self._name_ends[index]]
+
+    def _get_etag(self, index):
+        """
+        Gets the ETag at an index
+
+        :param index:
+        :return:
+        """
+        if index in self._odd_etags:
+            return self._odd_etags[index]
+
+        return unpack_etag(*self._get_packed_etag(index))
+
+
+class InventoryBuilder(object):
+    """
+    Packs objects as they are added, then builds the S3Inventory
+
+    Objects are kept in the same packed columns the inventory uses, in the
+    order they were added.  Building groups them by directory and only sorts
+    the directories that are out of order, listing S3 returns the names in each
+    directory sorted already.  Objects can be added from several threads.
+    """
+
+    def __init__(self):
+        self._dir_ids = {}
+        self._dirs = []
+        self._object_dirs = array('I')
+        self._names = bytearray()
+        self._name_ends = array('I')
+        self._digests = bytearray()
+        self._parts = array('H')
+        self._sizes = array(SIZE_TYPECODE)
+        self._content_type_ids = {None: 0}
+        self._content_types = [None]
+        self._object_content_types = array('H')
+        self._odd_etags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def add_items(self, items):
+        """
+        Packs objects, like a page of a listing
+
+        :param items: iterable of key, ETag, size and content type
+        :return:
+        """
+        with self._lock:
+            for key, etag, size, content_type in items:
+                encoded_key = encode_key(key)
+                split = encoded_key.rfind(b'/') + 1
+                directory = encoded_key[:split]
+                if directory not in self._dir_ids:
+                    self._dir_ids[directory] = len(self._dirs)
+                    self._dirs.append(directory)
+
+                packed_etag = pack_etag(etag)
+                if packed_etag is None:
+                    self._odd_etags[len(self._name_ends)] = etag
+                    packed_etag = (b'\0' * 16, 0)
+
+                if content_type not in self._content_type_ids:
+                    self._content_type_ids[content_type] = len(self._content_types)
+                    self._content_types.append(content_type)
+
+                self._object_dirs.append(self._dir_ids[directory])
+                self._names += encoded_key[split:]
+                self._name_ends.append(len(self._names))
+                self._digests += packed_etag[0]
+                self._parts.append(packed_etag[1])
+                self._sizes.append(size or 0)
+                self._object_content_types.append(self._content_type_ids[content_type])
+
+    def build(self):
+        """
+        Builds the inventory from every object added, a key added twice keeps the last one
+
+        :return:
+        """
+        inventory = S3Inventory()
+        names = bytearray()
+        digests = bytearray()
+        for directory, indexes, dir_names in self._iter_dirs():
+            if len(inventory._dirs) > 0:
+                inventory._dir_starts.append(len(inventory._name_ends))
+            inventory._dirs.append(directory)
+
+            for position, index in enumerate(indexes):
+                if position + 1 < len(indexes) and dir_names[position + 1] == dir_names[position]:
+                    continue
+
+                if index in self._odd_etags:
+                    inventory._odd_etags[len(inventory._name_ends)] = self._odd_etags[index]
+
+                names += dir_names[position]
+                inventory._name_ends.append(len(names))
+                digests += self._digests[index * 16:index * 16 + 16]
+                inventory._parts.append(self._parts[index])
+                inventory._sizes.append(self._sizes[index])
+                inventory._content_type_ids.append(self._object_content_types[index])
+
+        inventory._dir_starts.append(len(inventory._name_ends))
+        inventory._names = bytes(names)
+        inventory._digests = bytes(digests)
+        inventory._content_types = list(self._content_types)
+        return inventory
+
+    def _iter_dirs(self):
+        """
+        Yields each directory in order with its objects sorted by name
+
+        The objects are grouped by directory with a counting sort, the objects of
+        a directory stay in the order they were added unless they have to be sorted
+
+        :return: generator of the directory, an array of indexes and a list of their names
+        """
+        dir_order = sorted(range(len(self._dirs)), key=self._dirs.__getitem__)
+        dir_counts = array('I', [0]) * len(self._dirs)
+        for dir_id in self._object_dirs:
+            dir_counts[dir_id] += 1
+
+        dir_starts = array('I', [0]) * len(self._dirs)
+        next_start = 0
+        for dir_id in dir_order:
+            dir_starts[dir_id] = next_start
+            next_start += dir_counts[dir_id]
+
+        grouped = array('I', [0]) * len(self._object_dirs)
+        dir_ends = array('I', dir_starts)
+        for index, dir_id in enumerate(self._object_dirs):
+            grouped[dir_ends[dir_id]] = index
+            dir_ends[dir_id] += 1
+
+        name_ends = self._name_ends
+        for dir_id in dir_order:
+            indexes = grouped[dir_starts[dir_id]:dir_ends[dir_id]]
+            dir_names = [self._names[name_ends[index - 1] if index > 0 else 0:name_ends[index]] for index in indexes]
+            if any(dir_names[position - 1] > dir_names[position] for position in range(1, len(dir_names))):
+                # Sorting is stable so the last of any duplicate keys stays last
+                order = sorted(range(len(dir_names)), key=dir_names.__getitem__)
+                indexes = array('I', [indexes[position] for position in order])
+                dir_names = [dir_names[position] for position in order]
+
+            yield self._dirs[dir_id], indexes, dir_names
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Journal of the steps a deploy has finished
+
+Each step is flushed to disk as soon as it finishes, so a deploy that dies
+part way can be resumed with --resume and only runs the steps that are left.
+"""
+
+import json  # Writes each step as a line of JSON
+import os  # Removes the journal once the deploy is complete
+import threading  # Guards the journal file shared by the upload workers
+
+
+class DeployJournal(object):
+    """
+    Records each completed step of a deploy so an interrupted deploy can be resumed
+
+    The first line holds the plan, each line after it is a step that finished.
+    A deploy can save what was on S3 to snapshot_filename before it changes
+    anything, the snapshot is removed along with the journal.
+    """
+
+    def __init__(self, filename, logger):
+        self.filename = filename
+        self.logger = logger
+        self.snapshot_filename = filename + '.s3.gz'
+        self._journal_file = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def step_id(action, item):
+        """
+        Gets an id for a step that is the same after it has been through JSON
+
+        :param action:
+        :param item:
+        :return:
+        """
+        return json.dumps([action, item], sort_keys=True)
+
+    def start(self, plan):
+        """
+        Starts a new journal for the plan
+
+        :param plan:
+        :return:
+        """
+        if os.path.isfile(self.filename):
+            self.logger.warn('Replacing the journal of an unfinished deploy in %s' % self.filename)
+
+        if os.path.isfile(self.snapshot_filename):
+            os.remove(self.snapshot_filename)
+
+        self._journal_file = open(self.filename, 'w')
+        self._write({'plan': plan})
+
+    def resume(self):
+        """
+        Reads back the plan and the steps that already finished
+
+        :return: tuple of the plan and a set of step ids
+        """
+        if os.path.isfile(self.filename) is False:
+            raise SystemExit('There is no journal at %s to resume' % self.filename)
+
+        plan = None
+        completed_steps = set()
+        with open(self.filename, 'r') as journal_file:
+            for journal_line in journal_file:
+                try:
+                    entry = json.loads(journal_line)
+                except ValueError:
+                    # The last line can be cut short when the deploy died
+                    continue
+
+                if 'plan' in entry:
+                    plan = entry['plan']
+                else:
+                    completed_steps.add(self.step_id(entry['action'], entry['item']))
+
+        if plan is None:
+            raise SystemExit('The journal at %s does not have a plan' % self.filename)
+
+        self.logger.info('Resuming from %s with %s steps already done' % (self.filename, len(completed_steps)))
+        self._journal_file = open(self.filename, 'a')
+        # Makes sure a line cut short is not joined to the next step
+        self._journal_file.write('\n')
+        return plan, completed_steps
+
+    def record(self, action, item):
+        """
+        Records a step that finished
+
+        :param action:
+        :param item:
+        :return:
+        """
+        self._write({'action': action, 'item': item})
+
+    def finish(self):
+        """
+        Removes the journal once the deploy is complete
+
+        :return:
+        """
+        self._journal_file.close()
+        os.remove(self.filename)
+        if os.path.isfile(self.snapshot_filename):
+            os.remove(self.snapshot_filename)
+
+    def _write(self, entry):
+        """
+        Writes an entry and flushes it so it survives the process dying
+
+        :param entry:
+        :return:
+        """
+        with self._lock:
+            self._journal_file.write(json.dumps(entry) + '\n')
+            self._journal_file.flush()
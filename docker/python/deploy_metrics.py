@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Timers and counters for the deploy scripts
+
+Each deploy ends with a summary table and can write the same numbers to a JSON
+file so deploy performance can be tracked over time
+"""
+
+import json  # Writes the report
+import threading  # Guards the numbers shared by the workers
+import time  # Times each phase
+from contextlib import contextmanager  # Lets a phase be timed with a with block
+
+
+def percentile(samples, percent):
+    """
+    Gets the nearest rank percentile of the samples
+
+    :param samples: sorted list of numbers
+    :param percent:
+    :return:
+    """
+    if len(samples) < 1:
+        return None
+
+    rank = int(round(percent / 100.0 * len(samples) + 0.5)) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+class DeployMetrics(object):
+    """
+    Collects how long each phase took, counters and per-file latencies
+
+    Timers add up, so work that happens a file at a time (like hashing) can be
+    timed in the same way as a whole phase
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.started_at = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.samples = {}
+        self._timer_order = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times the with block and adds it to the timer
+
+        :param name:
+        :return:
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start_time)
+
+    def add_time(self, name, seconds):
+        """
+        Adds seconds to a timer
+
+        :param name:
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = 0.0
+                self._timer_order.append(name)
+
+            self.timers[name] += seconds
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter
+
+        :param name:
+        :param amount:
+        :return:
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """
+        Records how long one item took
+
+        :param name:
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def report(self):
+        """
+        Builds the report
+
+        :return:
+        """
+        with self._lock:
+            latencies = {}
+            for name, samples in self.samples.items():
+                samples = sorted(samples)
+                latencies[name] = {
+                    'count': len(samples),
+                    'p50': round(percentile(samples, 50), 4),
+                    'p95': round(percentile(samples, 95), 4),
+                    'max': round(samples[-1], 4)
+                }
+
+            return {
+                'tool': self.tool,
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started_at)),
+                'total_seconds': round(time.time() - self.started_at, 3),
+                'timers': [[name, round(self.timers[name], 3)] for name in self._timer_order],
+                'counters': dict(self.counters),
+                'latencies': latencies
+            }
+
+    @staticmethod
+    def write(filename, report):
+        """
+        Writes the report to a JSON file
+
+        :param filename:
+        :param report:
+        :return:
+        """
+        with open(filename, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+    @staticmethod
+    def log_summary(logger, report):
+        """
+        Logs the report as a table
+
+        :param logger:
+        :param report:
+        :return:
+        """
+        logger.info('%-24s %14s' % ('Timer', 'Seconds'))
+        for name, seconds in report['timers']:
+            logger.info('%-24s %14.3f' % (name, seconds))
+
+        logger.info('%-24s %14.3f' % ('total', report['total_seconds']))
+        logger.info('%-24s %14s' % ('Counter', 'Value'))
+        for name in sorted(report['counters']):
+            logger.info('%-24s %14s' % (name, report['counters'][name]))
+
+        for name in sorted(report['latencies']):
+            latency = report['latencies'][name]
+            logger.info('%s latency over %s: p50 %.3fs, p95 %.3fs, max %.3fs' % (
+                name, latency['count'], latency['p50'], latency['p95'], latency['max']))
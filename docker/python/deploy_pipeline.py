@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Streams files through the stages of a deploy
+
+The tree is walked with scandir so the stat of each file comes with the
+listing, and every file moves through the stages (filter, hash, upload) as
+soon as it is found.  Stages are joined by bounded queues, so uploads start
+right away and the memory used stays the same however big the tree is.
+"""
+
+import os  # Operating system functions
+import stat  # Tells files from directories
+import threading  # Runs each stage
+import sys  # Keeps the first error from the stages
+
+try:
+    from os import scandir  # Lists a directory along with the stat of each entry
+
+    have_scandir = True
+except ImportError:
+    try:
+        from scandir import scandir  # Back port of scandir for python 2
+
+        have_scandir = True
+    except ImportError:
+        have_scandir = False
+
+try:
+    from queue import Queue  # Joins the stages
+except ImportError:
+    from Queue import Queue  # Joins the stages
+
+# Items each queue between two stages can hold before the stage before it waits
+QUEUE_SIZE = 1024
+
+# Put on a queue after the last item
+DONE = object()
+
+
+def scan_tree(root, skip_dirs=('.git',)):
+    """
+    Walks the tree under root
+
+    With out scandir (python 2 with out the back port) each file is stat'ed instead
+
+    :param root:
+    :param skip_dirs: names of directories not to go in to
+    :return: generator of path and stat pairs for every file
+    """
+    pending_dirs = [root]
+    while len(pending_dirs) > 0:
+        current_dir = pending_dirs.pop()
+        try:
+            entries = list_dir(current_dir)
+        except OSError:
+            # Directories can go away while the deploy runs
+            continue
+
+        for entry_path, entry_name, entry_is_dir, entry_stat in entries:
+            if entry_is_dir is True:
+                if entry_name not in skip_dirs:
+                    pending_dirs.append(entry_path)
+                continue
+
+            if stat.S_ISREG(entry_stat.st_mode):
+                yield entry_path, entry_stat
+
+
+def list_dir(directory):
+    """
+    Lists a directory the way os.walk does
+
+    Links to files are followed, links to directories are not gone in to so a
+    link back to a parent can not loop forever
+
+    :param directory:
+    :return: list of the path, name, if it is a directory (not following links) and stat of each entry
+    """
+    entries = []
+    if have_scandir is True:
+        for entry in scandir(directory):
+            try:
+                entry_is_dir = entry.is_dir(follow_symlinks=False)
+                entries.append((entry.path, entry.name, entry_is_dir, None if entry_is_dir else entry.stat()))
+            except OSError:
+                continue
+
+        return entries
+
+    for entry_name in os.listdir(directory):
+        entry_path = os.path.join(directory, entry_name)
+        try:
+            entry_stat = os.lstat(entry_path)
+            if stat.S_ISLNK(entry_stat.st_mode):
+                entry_stat = os.stat(entry_path)
+                entries.append((entry_path, entry_name, False, entry_stat))
+            else:
+                entries.append((entry_path, entry_name, stat.S_ISDIR(entry_stat.st_mode), entry_stat))
+        except OSError:
+            continue
+
+    return entries
+
+
+class Pipeline(object):
+    """
+    Passes items from a source through stages, each run by its own threads
+
+    A stage is called with each item and returns what to pass on to the next
+    stage or None to drop the item.  Iterating the pipeline yields what comes
+    out of the last stage.  The first error in any stage stops the pipeline
+    and is raised from the iteration.
+    """
+
+    def __init__(self, source, queue_size=QUEUE_SIZE):
+        self.source = source
+        self.queue_size = queue_size
+        self._stages = []
+        self._error = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_stage(self, work, workers=1):
+        """
+        Adds a stage after the ones already added
+
+        :param work: called with each item
+        :param workers: threads running the stage
+        :return:
+        """
+        self._stages.append((work, workers))
+        return self
+
+    def __iter__(self):
+        out_queue = Queue(self.queue_size)
+        self._start(self._feed, [out_queue])
+        for work, workers in self._stages:
+            in_queue = out_queue
+            out_queue = Queue(self.queue_size)
+            remaining = [workers]
+            for worker in range(workers):
+                self._start(self._run_stage, [work, in_queue, out_queue, remaining])
+
+        while True:
+            item = out_queue.get()
+            if item is DONE:
+                break
+
+            yield item
+
+        if self._error is not None:
+            raise self._error
+
+    @staticmethod
+    def _start(target, target_args):
+        """
+        Starts a thread for a stage
+
+        Stages are daemon threads so a deploy that fails part way does not hang
+
+        :param target:
+        :param target_args:
+        :return:
+        """
+        thread = threading.Thread(target=target, args=target_args)
+        thread.daemon = True
+        thread.start()
+
+    def _feed(self, out_queue):
+        """
+        Puts the items from the source on the first queue
+
+        :param out_queue:
+        :return:
+        """
+        try:
+            for item in self.source:
+                if self._stop.is_set():
+                    break
+
+                out_queue.put(item)
+        except Exception:
+            self._fail()
+        finally:
+            out_queue.put(DONE)
+
+    def _run_stage(self, work, in_queue, out_queue, remaining):
+        """
+        Runs one worker of a stage until the queue before it is done
+
+        :param work:
+        :param in_queue:
+        :param out_queue:
+        :param remaining: list holding the number of workers of the stage still running
+        :return:
+        """
+        while True:
+            item = in_queue.get()
+            if item is DONE:
+                # Leave it for the other workers of the stage
+                in_queue.put(DONE)
+                break
+
+            if self._stop.is_set():
+                continue
+
+            try:
+                result = work(item)
+            except Exception:
+                self._fail()
+                continue
+
+            if result is not None:
+                out_queue.put(result)
+
+        with self._lock:
+            remaining[0] -= 1
+            last_worker = remaining[0] == 0
+
+        if last_worker is True:
+            out_queue.put(DONE)
+
+    def _fail(self):
+        """
+        Keeps the first error and stops the pipeline
+
+        :return:
+        """
+        with self._lock:
+            if self._error is None:
+                self._error = sys.exc_info()[1]
+
+        self._stop.set()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Saved plans of the deploy scripts
+
+A plan written by --plan holds every request a deploy is going to make, so it
+can be reviewed and then run as is with --apply.
+"""
+
+import json  # Reads and writes the plan
+import math  # Estimates request counts
+
+import deploy_transfer  # Sizes of the multipart uploads
+
+
+def load_plan(plan_file_name, logger):
+    """
+    Loads a plan written by --plan
+
+    :param plan_file_name:
+    :param logger:
+    :return:
+    """
+    try:
+        with open(plan_file_name, 'r') as plan_file:
+            plan = json.load(plan_file)
+    except (IOError, ValueError) as error:
+        raise SystemExit('Cannot read plan %s: %s' % (plan_file_name, error))
+
+    logger.info('Applying plan %s' % plan_file_name)
+    return plan
+
+
+def write_plan(plan, plan_file_name, logger):
+    """
+    Writes a plan for --apply to pick up
+
+    :param plan:
+    :param plan_file_name:
+    :param logger:
+    :return:
+    """
+    logger.info('Writing plan to %s' % plan_file_name)
+    with open(plan_file_name, 'w') as plan_file:
+        json.dump(plan, plan_file, indent=2, sort_keys=True)
+
+
+def count_requests(size):
+    """
+    Counts the requests needed to upload or copy an object of this size
+
+    :param size:
+    :return:
+    """
+    if size < deploy_transfer.MULTIPART_THRESHOLD:
+        return 1
+
+    # Create, one per part and complete
+    return int(math.ceil(size / float(deploy_transfer.MULTIPART_CHUNKSIZE))) + 2
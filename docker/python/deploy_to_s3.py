@@ -7,23 +7,28 @@ import logging  # logging
 import os  # Operating system functions
 import sys  # System functions
 import argparse  # parse args from the command line
-import subprocess  # makes system calls
-import hashlib  # used to compare files
-import threading  # used to display a progress bar with out blocking
 import json  # Used to parse JSON Strings
+import time  # Times how long linking takes
 
 try:
     import boto3  # Aws API
+    from botocore.exceptions import ClientError  # Raised when a request to AWS fails
 except ImportError:
     print ('You are missing boto3.  run: pip install boto3')
     sys.exit(1)
 
+import deploy_transfer  # Shared multipart settings, retries and throttling
+import deploy_metrics  # Times each phase of the deploy
+import deploy_hashing  # Hashes files on every core
+import deploy_pipeline  # Walks the tree with scandir
+import deploy_journal  # Records finished steps so a deploy can be resumed
+import deploy_assets  # Mime types, compression and Cache-Control of the files
+import deploy_plan  # Saved plans for --plan and --apply
+
 try:
-    import magic  # Mime type detector
+    from concurrent.futures import ThreadPoolExecutor  # Worker pool for listing
 except ImportError:
-    print ('You are missing boto3.')
-    print ('to fix run: brew install libmagic')
-    print ('then: pip install python-magic')
+    print ('You are missing futures.  run: pip install futures')
     sys.exit(1)
 
 try:
@@ -48,25 +53,6 @@ logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
 
-def get_md5(filename):
-    """
-    Gets the MD5 hash of a file
-
-    :param filename:
-    :return:
-    """
-    read_file = open(filename, 'rb')
-    md5 = hashlib.md5()
-    while True:
-        data = read_file.read(10240)
-        if len(data) == 0:
-            break
-        md5.update(data)
-
-    read_file.close()
-    return md5.hexdigest()
-
-
 def chunks(l, n):
     """
     Yield successive n-sized chunks from l.
@@ -79,40 +65,10 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
-class ProgressPercentage(object):
-    """
-    Displays a nice percentage bar when uploading
-    """
-
-    def __init__(self, filename):
-        self._filename = os.path.basename(filename)
-        self._size = float(os.path.getsize(filename))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
-
-    def __call__(self, bytes_amount):
-        # To simplify we'll assume this is hooked up
-        # to a single filename.
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                "\r%s  %s / %s  (%.2f%%)" % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage))
-            sys.stdout.flush()
-
-
 class CMWNDeploy(object):
     """
     Deploy class for games
     """
-    mime_maps = {
-        'css': 'text/css',
-        'js.map': 'application/javascript',
-        'js': 'application/javascript'
-    }
-
     links_ref = {
         'rc': '_STAGING',
         'qa': '_QA',
@@ -120,35 +76,283 @@ class CMWNDeploy(object):
         'demo': '_DEMO'
     }
 
-    def __init__(self):
+    # Used with --content-addressed: each file is stored once under its hash and
+    # each version is a manifest mapping paths to hashes
+    blob_prefix = '_blobs/'
+    manifest_prefix = '_manifests/'
+
+    # Used to estimate how long a plan will take
+    plan_bandwidth = 10 * 1024 * 1024  # bytes per second
+    plan_request_latency = 0.05  # seconds per request
+
+    # <link>/index.html of a pointer link, sends browsers on to the version
+    pointer_page = ('<!DOCTYPE html>\n'
+                    '<html><head><meta charset="utf-8">'
+                    '<meta http-equiv="refresh" content="0; url=%(url)s">'
+                    '<script>location.replace(%(js_url)s + location.search + location.hash)</script>'
+                    '</head><body><a href="%(url)s">%(url)s</a></body></html>\n')
+
+    def __init__(self, argv=None):
         self.files_to_deploy = []
-        self.s3 = boto3.resource('s3')
+        self.delete_failures = []
+        self.mime_detector = deploy_assets.MimeDetector(logger)
+        self.metrics = deploy_metrics.DeployMetrics('deploy_to_s3')
 
         # Load in the command line arguments
-        args = self._parse_cli()
-        self.cache_time = args.cache_time
+        args = self._parse_cli(argv)
+        self.cache_policy = deploy_assets.CachePolicy(args.cache_time, args.cache_rule, args.cache_rules, logger)
+        self.jobs = args.jobs
+        # Listing is one small request per page, so it gets more workers than the uploads by default
+        self.list_jobs = args.list_jobs if args.list_jobs is not None else max(self.jobs, 8)
+        self.hash_processes = args.hash_processes
+        deploy_transfer.set_multipart(args.multipart_threshold, args.multipart_chunksize)
+        self.compress = args.compress
+        self.compress_cache = args.compress_cache
+        self.compressor = deploy_assets.Compressor(self.compress, self.compress_cache, args.compress_min_saving,
+                                                   self.mime_detector, logger)
+
+        if self.compress == 'br' and deploy_assets.have_brotli is False:
+            raise SystemExit('You are missing brotli.  run: pip install brotli')
+
+        if self.jobs < 1:
+            raise SystemExit('--jobs must be at least 1')
+
+        if self.list_jobs < 1:
+            raise SystemExit('--list-jobs must be at least 1')
+
+        # One client (and connection pool) is shared by every upload worker
+        self.transfer = deploy_transfer.TransferController(self.jobs, logger, max_attempts=args.max_attempts)
+        self.s3 = boto3.resource('s3', config=self.transfer.client_config)
+        self.transfer.watch(self.s3.meta.client)
+        self.progress = deploy_transfer.TransferProgress()
         self.source_dir = args.source
         self.bucket_name = args.bucket
         self.package_file = args.package_file
-        self.version = self._get_version_from_file(args.version)
+        self.version = None
+        # A saved plan or journal carries the version it deploys
+        if args.version is not None or (args.apply is None and args.resume is False):
+            self.version = self._get_version_from_file(args.version)
         self.link = self._get_link_directory(args.link)
         self.link_only = args.link_only
+        self.link_mode = args.link_mode
+        self.content_addressed = args.content_addressed
         self.bucket = self.s3.Bucket(self.bucket_name)
+        self.journal = deploy_journal.DeployJournal(args.journal, logger)
+        try:
+            self._deploy(args)
+        finally:
+            self.transfer.log_throttles()
+            self._report_metrics(args.metrics_file)
+
+    def _deploy(self, args):
+        """
+        Plans the deploy, or picks up a saved plan, then applies it
+
+        :param args:
+        :return:
+        """
+        completed_steps = set()
+        if args.resume is True:
+            plan, completed_steps = self.journal.resume()
+            self._check_plan(plan, args.journal)
+        elif args.apply is not None:
+            plan = deploy_plan.load_plan(args.apply, logger)
+            self._check_plan(plan, args.apply)
+        else:
+            plan = self._build_plan()
+
+        self._log_plan(plan)
+        if args.plan is not None:
+            deploy_plan.write_plan(plan, args.plan, logger)
+
+            print ('Plan is complete')
+            return
+
+        if args.resume is False:
+            self.journal.start(plan)
+
+        self._apply_plan(plan, completed_steps)
+        self.journal.finish()
+        print ('Deploy is complete')
+
+    def _report_metrics(self, metrics_file):
+        """
+        Logs the timers and counters for the deploy and writes them to the metrics file
+
+        :param metrics_file:
+        :return:
+        """
+        self.metrics.count('requests', self.transfer.requests)
+        self.metrics.count('retries', self.transfer.retries)
+        self.metrics.count('throttles', sum(self.transfer.throttles.values()))
+
+        report = self.metrics.report()
+        self.metrics.log_summary(logger, report)
+        if metrics_file is not None:
+            logger.info('Writing metrics to %s' % metrics_file)
+            self.metrics.write(metrics_file, report)
+
+    def _build_plan(self):
+        """
+        Works out everything the deploy needs to do with out changing S3
+
+        :return:
+        """
+        plan = {
+            'tool': 'deploy_to_s3',
+            'bucket': self.bucket_name,
+            'source': self.source_dir,
+            'version': self.version,
+            'link': self.link,
+            'link_mode': self.link_mode,
+            'uploads': [],
+            'manifest': None,
+            'pointer': False,
+            'stale': [],
+            'copies': [],
+            'skips': []
+        }
 
         if self.link_only is False:
             logger.info('Deploying %s to %s' % (self.source_dir, self.bucket_name))
 
-            self._check_version_on_s3()
-            self._get_files_to_deploy()
+            with self.metrics.timer('list'):
+                self._check_version_on_s3()
+
+            with self.metrics.timer('scan'):
+                self._get_files_to_deploy()
+
+            if self.compress is not None:
+                with self.metrics.timer('compress'):
+                    self.compressor.compress_files(self.files_to_deploy, self._hash_files)
+
+            if self.content_addressed is True:
+                with self.metrics.timer('plan blobs'):
+                    plan['manifest'], plan['uploads'] = self._plan_blobs()
+            else:
+                for deploy_file_name in self.files_to_deploy:
+                    upload_file, content_encoding = self.compressor.get_upload_file(deploy_file_name)
+                    plan['uploads'].append([deploy_file_name, self._get_dest_key(deploy_file_name),
+                                            os.path.getsize(upload_file)])
+
+        if self.link is not None and self.link_mode == 'pointer':
+            plan['pointer'] = True
+            # Objects copied there before would be served in place of the version
+            with self.metrics.timer('plan link'):
+                plan['stale'] = sorted(key for key in self._list_objects(self.link + '/')
+                                       if key != self.link + '/index.html')
+
+            if len(plan['stale']) > 0:
+                logger.warn('%s objects copied to %s/ by earlier deploys will be deleted' % (len(plan['stale']),
+                                                                                            self.link))
+        elif self.link is not None:
+            with self.metrics.timer('plan link'):
+                plan['copies'], plan['skips'] = self._plan_link(plan)
+
+        plan['compressed_files'] = self.compressor.compressed_files
+        return plan
+
+    def _check_plan(self, plan, plan_file_name):
+        """
+        Makes sure a saved plan is for this bucket and picks up what it deploys
 
-            logger.info('Uploading %s files to S3' % len(self.files_to_deploy))
-            for deploy_file_name in self.files_to_deploy:
-                self._push_to_s3(deploy_file_name)
+        :param plan:
+        :param plan_file_name:
+        :return:
+        """
+        if plan.get('tool') != 'deploy_to_s3':
+            raise SystemExit('%s is not a plan for deploy_to_s3' % plan_file_name)
 
-        if self.link is not None:
-            self._link()
+        if plan['bucket'] != self.bucket_name:
+            raise SystemExit('Plan %s is for bucket %s not %s' % (plan_file_name, plan['bucket'], self.bucket_name))
 
-        print ('Deploy is complete')
+        # The plan decides what is deployed and linked
+        self.source_dir = plan['source']
+        self.version = plan['version']
+        self.link = plan['link']
+        self.compressor.compressed_files = plan['compressed_files']
+
+    def _log_plan(self, plan):
+        """
+        Adds the byte totals and estimates to the plan and logs a summary
+
+        :param plan:
+        :return:
+        """
+        upload_bytes = sum(upload[2] for upload in plan['uploads'])
+        copy_bytes = sum(copy[2] for copy in plan['copies'])
+        requests = sum(deploy_plan.count_requests(upload[2]) for upload in plan['uploads'])
+        # Multipart copies also need a HEAD request to find the size
+        requests += sum(deploy_plan.count_requests(copy[2])
+                        + (1 if copy[2] >= deploy_transfer.MULTIPART_THRESHOLD else 0) for copy in plan['copies'])
+        requests += (1 if plan['manifest'] is not None else 0) + (2 if plan['pointer'] else 0)
+        requests += (len(plan.get('stale', [])) + 999) // 1000
+
+        plan['totals'] = {
+            'upload_files': len(plan['uploads']),
+            'upload_bytes': upload_bytes,
+            'copy_objects': len(plan['copies']),
+            'copy_bytes': copy_bytes,
+            'skipped_objects': len(plan['skips']),
+            'requests': requests,
+            'estimated_seconds': round(upload_bytes / float(self.plan_bandwidth) +
+                                       requests * self.plan_request_latency / self.jobs, 2)
+        }
+
+        logger.info('Plan: upload %(upload_files)s files (%(upload_bytes)s bytes), '
+                    'copy %(copy_objects)s objects (%(copy_bytes)s bytes), skip %(skipped_objects)s, '
+                    '~%(requests)s requests, ~%(estimated_seconds)ss' % plan['totals'])
+
+    def _apply_plan(self, plan, completed_steps):
+        """
+        Uploads and links everything in the plan
+
+        :param plan:
+        :param completed_steps: step ids from the journal that do not need to run again
+        :return:
+        """
+        uploads = [upload for upload in plan['uploads']
+                   if deploy_journal.DeployJournal.step_id('upload', upload) not in completed_steps]
+        if len(uploads) > 0:
+            logger.info('Uploading %s files to S3 using %s workers' % (len(uploads), self.jobs))
+            self.progress.start('Uploaded', len(uploads), sum(upload[2] for upload in uploads))
+            try:
+                with self.metrics.timer('upload'):
+                    failed_uploads = deploy_transfer.run_in_pool(self._push_upload, uploads, self.jobs,
+                                                                 'upload', logger, self.journal)
+            finally:
+                self.progress.stop()
+
+            if len(failed_uploads) > 0:
+                logger.critical('%s of %s files failed to upload' % (len(failed_uploads), len(uploads)))
+                sys.exit(4)
+
+        manifest_key = self._get_manifest_key()
+        manifest_step = deploy_journal.DeployJournal.step_id('manifest', manifest_key)
+        if plan['manifest'] is not None and manifest_step not in completed_steps:
+            logger.info('Writing manifest %s' % self._get_manifest_key())
+            self.transfer.call(
+                manifest_key,
+                self.s3.meta.client.put_object,
+                Bucket=self.bucket_name,
+                Key=self._get_manifest_key(),
+                Body=json.dumps(plan['manifest']),
+                ACL='public-read',
+                ContentType='application/json',
+            )
+            self.journal.record('manifest', manifest_key)
+
+        if plan['pointer'] is True:
+            if deploy_journal.DeployJournal.step_id('pointer', plan['link']) not in completed_steps:
+                with self.metrics.timer('link'):
+                    self._link_pointer(plan.get('stale', []))
+
+                self.journal.record('pointer', plan['link'])
+        elif plan['link'] is not None:
+            copies = [copy for copy in plan['copies']
+                      if deploy_journal.DeployJournal.step_id('link', copy) not in completed_steps]
+            with self.metrics.timer('link'):
+                self._link(copies, len(plan['skips']) + len(plan['copies']) - len(copies))
 
     def _get_link_directory(self, link):
         """
@@ -166,34 +370,238 @@ class CMWNDeploy(object):
 
         raise SystemExit('Cannot link to %s' % link)
 
-    def _link(self):
+    def _plan_link(self, plan):
+        """
+        Works out the objects to copy to link the version to an environment
+
+        Any object the environment already has with the same ETag is skipped
+
+        :param plan: the plan so far, used when the version is not on S3 yet
+        :return: tuple of the objects to copy and the keys skipped
+        """
+        version_prefix = self.version + '/'
+        link_prefix = self.link + '/'
+        linked_objects = self._list_objects(link_prefix)
+
+        objects_to_link = []
+        skipped = []
+        manifest = plan['manifest']
+        if manifest is None and self.link_only is True:
+            manifest = self._get_manifest()
+
+        if manifest is not None:
+            # Content addressed versions are built from their blobs
+            version_objects = {}
+            for path, blob in manifest['files'].items():
+                metadata = {
+                    'ContentType': blob['content_type'],
+                    'CacheControl': self.cache_policy.get_cache_control(path)
+                }
+
+                if blob.get('content_encoding') is not None:
+                    metadata['ContentEncoding'] = blob['content_encoding']
+
+                # Manifests from before the ETag was kept only have the MD5, big blobs are copied again
+                version_objects[path] = (self.blob_prefix + blob['md5'], blob.get('etag', blob['md5']), blob['size'],
+                                         metadata)
+        elif self.link_only is False:
+            # The version is about to be uploaded so use the local files
+            version_objects = {}
+            etags = self._hash_files([self.compressor.get_upload_file(upload[0])[0] for upload in plan['uploads']],
+                                     True)
+            for source_file, dest_key, size in plan['uploads']:
+                upload_file, content_encoding = self.compressor.get_upload_file(source_file)
+                version_objects[dest_key[len(version_prefix):]] = (dest_key, etags[upload_file], size, None)
+        else:
+            version_objects = dict((s3_key[len(version_prefix):], (s3_key, s3_etag, s3_size, None))
+                                   for s3_key, (s3_etag, s3_size) in self._list_objects(version_prefix).items())
+
+        for path, (source_key, etag, size, metadata) in version_objects.items():
+            dest_key = link_prefix + path
+            if dest_key in linked_objects and linked_objects[dest_key][0] == etag:
+                logger.debug('%s is already linked' % dest_key)
+                skipped.append(dest_key)
+                continue
+
+            objects_to_link.append([source_key, dest_key, size, metadata])
+
+        return objects_to_link, skipped
+
+    def _link(self, objects_to_link, skipped):
         """
         Links the version to an environment
 
+        Objects are copied server side by a pool of workers
+
+        :param objects_to_link: list of source key, destination key, size and metadata
+        :param skipped: number of objects that are already linked
         :return:
         """
-        s3_objects = self.bucket.objects.filter(Prefix=self.version)
-        for s3_object in s3_objects:
-            copy_source = {
-                'Bucket': self.bucket_name,
-                'Key': s3_object.key
-            }
+        logger.info('Linking %s to %s using %s workers' % (self.version, self.link, self.jobs))
+        start_time = time.time()
+        self.progress.start('Linked', len(objects_to_link), sum(link_object[2] for link_object in objects_to_link))
+        try:
+            failed_objects = deploy_transfer.run_in_pool(self._copy_object, objects_to_link, self.jobs,
+                                                         'link', logger, self.journal)
+        finally:
+            self.progress.stop()
+
+        if len(failed_objects) > 0:
+            logger.critical('%s of %s objects failed to link' % (len(failed_objects), len(objects_to_link)))
+            sys.exit(4)
+
+        elapsed = max(time.time() - start_time, 0.001)
+        linked_bytes = sum(link_object[2] for link_object in objects_to_link)
+        logger.info('Linked %s objects (%.2f MB) in %.2fs (%.2f objects/s), skipped %s unchanged' % (
+            len(objects_to_link), linked_bytes / 1048576.0, elapsed, len(objects_to_link) / elapsed, skipped))
+
+    def _link_pointer(self, stale_keys):
+        """
+        Links the version to an environment by pointing at it
 
-            dest_key = str(s3_object.key).replace(self.version + '/', self.link + '/')
-            logger.info('Linking %s to %s' % (copy_source, dest_key))
-            self.bucket.copy(
-                copy_source,
+        Writes <link>.json naming the version and a <link>/index.html redirect to
+        the version, so promoting or rolling back costs the same no matter how
+        big the release is.  <link>.json does not redirect, clients read it to
+        find the version.  <link>/index.html is a page that sends browsers on to
+        the version, so it works through the REST endpoint and proxies in front
+        of it (like nginx).  The S3 website endpoint redirects before serving it.
+
+        Objects an earlier copy link left under <link>/ are deleted once the
+        pointer is written, other wise they would be served in place of the version.
+
+        :param stale_keys: keys under <link>/ to delete
+        :return:
+        """
+        version_prefix = self.version + '/'
+        pointer = {
+            'version': self.version,
+            'prefix': version_prefix,
+            'linked_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+
+        if self._get_manifest() is not None:
+            pointer['manifest'] = self._get_manifest_key()
+        elif self._has_objects(version_prefix) is False:
+            raise SystemExit('Version %s is not deployed to S3' % self.version)
+
+        logger.info('Pointing %s at %s' % (self.link, self.version))
+        self.transfer.call(
+            self.link,
+            self.s3.meta.client.put_object,
+            Bucket=self.bucket_name,
+            Key=self.link + '.json',
+            Body=json.dumps(pointer),
+            ACL='public-read',
+            ContentType='application/json',
+            CacheControl='no-cache',
+        )
+
+        if 'manifest' in pointer:
+            # There are no objects under the version prefix to redirect to
+            stale_keys = list(stale_keys) + [self.link + '/index.html']
+        else:
+            # The S3 website endpoint redirects on the header, everything else serves the page
+            version_index = '/%sindex.html' % version_prefix
+            self.transfer.call(
+                self.link,
+                self.s3.meta.client.put_object,
+                Bucket=self.bucket_name,
+                Key=self.link + '/index.html',
+                Body=self.pointer_page % {'url': version_index, 'js_url': json.dumps(version_index)},
+                ACL='public-read',
+                ContentType='text/html',
+                CacheControl='no-cache',
+                WebsiteRedirectLocation=version_index,
+            )
+
+        if len(stale_keys) < 1:
+            return
+
+        logger.info('Deleting %s objects under %s/' % (len(stale_keys), self.link))
+        failed_batches = deploy_transfer.run_in_pool(self._delete_batch, chunks(stale_keys, 1000), self.jobs,
+                                                     'delete', logger)
+        failed_keys = self.delete_failures + [key for batch in failed_batches for key in batch]
+        if len(failed_keys) > 0:
+            logger.critical('%s of %s objects under %s/ failed to delete' % (len(failed_keys), len(stale_keys),
+                                                                            self.link))
+            sys.exit(4)
+
+    def _delete_batch(self, keys):
+        """
+        Deletes a batch of up to 1000 keys from S3
+
+        :param keys:
+        :return:
+        """
+        s3_delete_result = self.transfer.call(
+            keys[0],
+            self.s3.meta.client.delete_objects,
+            Bucket=self.bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+
+        for error in s3_delete_result.get('Errors', []):
+            logger.critical("\tKey: %s \n\tError: %s" % (error['Key'], error['Message']))
+            self.delete_failures.append(error['Key'])
+
+    def _copy_object(self, link_object):
+        """
+        Copies an object on S3 to its linked key
+
+        Small objects are copied with a single request, larger ones are copied in
+        parts matching the upload so the ETag stays the same
+
+        :param link_object: list of source key, destination key, size and the
+                            metadata to set (None keeps the source metadata)
+        :return:
+        """
+        source_key, dest_key, size, metadata = link_object
+        copy_source = {
+            'Bucket': self.bucket_name,
+            'Key': source_key
+        }
+
+        extra_args = {
+            'ACL': 'public-read',
+        }
+
+        if metadata is not None:
+            extra_args['MetadataDirective'] = 'REPLACE'
+            extra_args.update(metadata)
+
+        logger.debug('Linking %s to %s' % (source_key, dest_key))
+        start_time = time.time()
+        if size < deploy_transfer.MULTIPART_THRESHOLD:
+            self.transfer.call(
+                dest_key,
+                self.s3.meta.client.copy_object,
+                CopySource=copy_source,
+                Bucket=self.bucket_name,
                 Key=dest_key,
-                ExtraArgs={
-                    'ACL': 'public-read',
-                },
+                **extra_args
             )
+        else:
+            self.transfer.call(
+                dest_key,
+                self.s3.meta.client.copy,
+                copy_source,
+                self.bucket_name,
+                dest_key,
+                ExtraArgs=extra_args,
+                Config=self.transfer.transfer_config,
+            )
+
+        self.progress.file_done(size)
+        self.metrics.observe('link', time.time() - start_time)
+        self.metrics.count('objects_linked')
+        self.metrics.count('bytes_linked', size)
 
     @staticmethod
-    def _parse_cli():
+    def _parse_cli(argv=None):
         """
         Gets the CLI parameters
 
+        :param argv: arguments to parse instead of the command line
         :return:
         """
         # Set some defaults from the environment variables
@@ -209,11 +617,46 @@ class CMWNDeploy(object):
         parser.add_argument('--package-file', help='Version', default=package_file)
         parser.add_argument('--link', help='Link this version to an environment')
         parser.add_argument('--link-only', help="Only create a link to version", action='store_true')
+        parser.add_argument('--link-mode', help='Copy the version to the environment or write a pointer to it.  '
+                                                'A pointer is <link>.json for clients to read and a <link>/index.html '
+                                                'page that sends browsers to the version.  Switching to pointer '
+                                                'deletes the objects copied under <link>/',
+                            choices=['copy', 'pointer'], default='copy')
+        parser.add_argument('--content-addressed',
+                            help='Store each file once under its hash with a manifest per version',
+                            action='store_true')
         parser.add_argument('-ct', '--cache-time', help='Time for cache', default='86400')
+        parser.add_argument('--cache-rule', help='Cache-Control for paths matching a glob, as GLOB=CACHE_CONTROL',
+                            action='append', default=[])
+        parser.add_argument('--cache-rules', help='JSON file of glob to Cache-Control rules')
         parser.add_argument('--bucket', help='Force to this bucket', default=bucket_name)
+        parser.add_argument('--compress', help='Upload text assets compressed with this encoding',
+                            choices=['gzip', 'br'])
+        parser.add_argument('--compress-cache', help='Directory used to cache compressed files',
+                            default='.deploy_compressed')
+        parser.add_argument('--compress-min-saving', help='Only upload compressed files that are at least this '
+                                                          'percent smaller', type=int, default=10)
+        parser.add_argument('-j', '--jobs', help='Number of files to upload or link at the same time', type=int,
+                            default=1)
+        parser.add_argument('--list-jobs', help='Number of prefixes to list at the same time, defaults to --jobs or 8 '
+                                                'whichever is more', type=int)
+        parser.add_argument('--hash-processes', help='Number of processes used to hash files, defaults to one per core',
+                            type=int)
+        parser.add_argument('--multipart-threshold', help='Upload files this many MB or bigger in parts', type=int,
+                            default=8)
+        parser.add_argument('--multipart-chunksize', help='Size in MB of each part of a multipart upload', type=int,
+                            default=8)
+        parser.add_argument('--max-attempts', help='Times to try a request that S3 throttles or drops', type=int,
+                            default=8)
+        parser.add_argument('--plan', help='Write what the deploy would do to this JSON file with out changing S3')
+        parser.add_argument('--metrics-file', help='Write the timers and counters for the deploy to this JSON file')
+        parser.add_argument('--apply', help='Deploy using a plan written by --plan')
+        parser.add_argument('--journal', help='File recording each finished step so the deploy can be resumed',
+                            default='.deploy_to_s3.journal')
+        parser.add_argument('--resume', help='Continue an interrupted deploy from its journal', action='store_true')
         parser.add_argument('-v', '--verbose', help='Turn on debugging logging', action='store_true')
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         if args.verbose:
             logger.setLevel(logging.DEBUG)
             logger.debug('Turning on debug')
@@ -233,6 +676,9 @@ class CMWNDeploy(object):
             return force_version
 
         logger.debug('Current self.package_file %s' % self.package_file)
+        if self.package_file is None:
+            raise SystemExit('Set --version or --package-file (or PACKAGE_FILE) to know what version to deploy')
+
         dir_path = os.path.dirname(os.path.realpath(__file__))
 
         good_json = open(dir_path + "/" + self.package_file).read()
@@ -247,10 +693,162 @@ class CMWNDeploy(object):
         :return:
         """
         logger.info('Fetching current files on S3')
-        s3_objects = self.bucket.objects.filter(Prefix=self.version)
-        for s3_object in s3_objects:
+        if self._has_objects(self.version + '/') or self._get_manifest() is not None:
             raise SystemExit('This version is already deployed to S3 please bump the version number')
 
+    def _has_objects(self, prefix):
+        """
+        Checks if there are any objects under the prefix with a single request
+
+        :param prefix:
+        :return:
+        """
+        s3_list = self.transfer.call(prefix, self.s3.meta.client.list_objects_v2, Bucket=self.bucket_name,
+                                     Prefix=prefix, MaxKeys=1)
+        return len(s3_list.get('Contents', [])) > 0
+
+    def _list_objects(self, prefix, shards=None):
+        """
+        Lists the objects under a prefix
+
+        Each shard of the prefix is listed concurrently.  With out shards, the
+        "directories" directly under the prefix are used as the shards.
+
+        :param prefix:
+        :param shards: prefixes that together cover every key under prefix
+        :return: dict of key to a tuple of ETag and size
+        """
+        s3_objects = {}
+        if shards is None:
+            s3_objects, shards = self._list_prefix(prefix, '/')
+
+        logger.debug('Listing %s using %s shards' % (prefix, len(shards)))
+        with ThreadPoolExecutor(max_workers=self.list_jobs) as executor:
+            for shard_objects, common_prefixes in executor.map(self._list_prefix, shards):
+                s3_objects.update(shard_objects)
+
+        return s3_objects
+
+    def _list_prefix(self, prefix, delimiter=None):
+        """
+        Lists the objects under a prefix one page at a time
+
+        :param prefix:
+        :param delimiter: when set, keys past the delimiter are returned as common prefixes
+        :return: tuple of a dict of key to ETag and size, and a list of the common prefixes
+        """
+        s3_objects = {}
+        common_prefixes = []
+        list_args = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter is not None:
+            list_args['Delimiter'] = delimiter
+
+        while True:
+            page = self.transfer.call(prefix, self.s3.meta.client.list_objects_v2, **list_args)
+            for s3_object in page.get('Contents', []):
+                s3_objects[s3_object['Key']] = (s3_object['ETag'].strip('"'), s3_object['Size'])
+
+            common_prefixes += [common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])]
+            if page.get('IsTruncated') is not True:
+                break
+
+            list_args['ContinuationToken'] = page['NextContinuationToken']
+
+        return s3_objects, common_prefixes
+
+    def _get_manifest_key(self):
+        """
+        Gets the key of the manifest for the version
+
+        :return:
+        """
+        return '%s%s.json' % (self.manifest_prefix, self.version)
+
+    def _get_manifest(self):
+        """
+        Fetches the manifest for a content addressed version
+
+        :return: the manifest or None when the version has no manifest
+        """
+        try:
+            manifest_object = self.transfer.call(self._get_manifest_key(), self.s3.meta.client.get_object,
+                                                 Bucket=self.bucket_name, Key=self._get_manifest_key())
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+        return json.loads(manifest_object['Body'].read().decode('utf-8'))
+
+    def _plan_blobs(self):
+        """
+        Works out the manifest and blobs to upload for a content addressed deploy
+
+        Only blobs the bucket does not have yet are uploaded
+
+        :return: tuple of the manifest and the uploads
+        """
+        logger.info('Hashing %s files' % len(self.files_to_deploy))
+        manifest_files = {}
+        blobs = {}
+        # Compressed files are stored as their own blob
+        upload_files = [self.compressor.get_upload_file(deploy_file_name)[0]
+                        for deploy_file_name in self.files_to_deploy]
+        md5s = self._hash_files(upload_files)
+        # Blobs uploaded in parts get an ETag that is not their MD5, links are compared on the ETag
+        etags = self._hash_files([upload_file for upload_file in upload_files
+                                  if os.path.getsize(upload_file) >= deploy_transfer.MULTIPART_THRESHOLD], True)
+        for deploy_file_name in self.files_to_deploy:
+            upload_file, content_encoding = self.compressor.get_upload_file(deploy_file_name)
+            md5 = md5s[upload_file]
+            manifest_files[os.path.relpath(deploy_file_name, self.source_dir)] = {
+                'md5': md5,
+                'etag': etags.get(upload_file, md5),
+                'size': os.path.getsize(upload_file),
+                'content_type': self.mime_detector.get_mime(deploy_file_name),
+                'content_encoding': content_encoding
+            }
+            blobs.setdefault(md5, deploy_file_name)
+
+        logger.info('Fetching current blobs on S3')
+        # Blobs are named by their hash so the first hex digit splits them evenly
+        blob_shards = [self.blob_prefix + hex_digit for hex_digit in '0123456789abcdef']
+        blobs_on_s3 = set(s3_key[len(self.blob_prefix):]
+                          for s3_key in self._list_objects(self.blob_prefix, blob_shards))
+
+        uploads = [[blob_file, self.blob_prefix + md5, os.path.getsize(self.compressor.get_upload_file(blob_file)[0])]
+                   for md5, blob_file in blobs.items() if md5 not in blobs_on_s3]
+        logger.info('%s of %s blobs need uploading' % (len(uploads), len(blobs)))
+        return {'version': self.version, 'files': manifest_files}, uploads
+
+    def _push_upload(self, upload):
+        """
+        Pushes a planned upload up to aws
+
+        :param upload: list of the source file, destination key and size
+        :return:
+        """
+        self._push_to_s3(upload[0], upload[1])
+
+    def _hash_files(self, file_names, etags=False):
+        """
+        Gets the MD5 hash of each file using a pool of worker processes, counting the time and bytes it takes
+
+        :param file_names:
+        :param etags: get the ETag S3 reports once the file is uploaded, which is not the MD5 for files sent in parts
+        :return: dict of file name to MD5 (or ETag)
+        """
+        multipart = (None, None)
+        if etags is True:
+            multipart = (deploy_transfer.MULTIPART_THRESHOLD, deploy_transfer.MULTIPART_CHUNKSIZE)
+
+        with self.metrics.timer('hash'):
+            hashes = deploy_hashing.hash_files(file_names, self.hash_processes, *multipart)
+
+        self.metrics.count('files_hashed', len(hashes))
+        self.metrics.count('bytes_hashed', sum(os.path.getsize(file_name) for file_name in hashes))
+        return hashes
+
     def _get_files_to_deploy(self):
         """
         Builds a list of files to deploy
@@ -258,21 +856,21 @@ class CMWNDeploy(object):
         :return:
         """
         logger.info('Build list of files to deploy')
-        for real_dir, dir_name, file_names in os.walk(self.source_dir, topdown=True):
-            base_dir = real_dir.replace(os.getcwd() + '/', "")
-            test = [self._filter_file(file_name, base_dir) for file_name in file_names]
-            self.files_to_deploy += filter(lambda v: v is not None, test)
+        base_dir = os.getcwd() + '/'
+        for file_path, file_stat in deploy_pipeline.scan_tree(self.source_dir):
+            self.metrics.count('files_scanned')
+            deploy_file_name = self._filter_file(file_path.replace(base_dir, '', 1))
+            if deploy_file_name is not None:
+                self.files_to_deploy.append(deploy_file_name)
 
     @staticmethod
-    def _filter_file(filter_file_name, path):
+    def _filter_file(check_file):
         """
         Filters out files that do not need to be deployed
 
-        :param filter_file_name:
-        :param path:
+        :param check_file:
         :return:
         """
-        check_file = os.path.join(path, filter_file_name)
         # Skip the .git folder
         if check_file.startswith('.git'):
             logger.debug('Skipping git folder')
@@ -282,35 +880,60 @@ class CMWNDeploy(object):
         logger.debug('Checking file %s' % check_file)
         return check_file
 
-    def _push_to_s3(self, source_file):
+    def _get_dest_key(self, source_file):
+        """
+        Gets the key of a file under the version
+
+        :param source_file:
+        :return:
+        """
+        return str(source_file).replace(self.source_dir, self.version)
+
+    def _push_to_s3(self, source_file, dest_file=None):
         """
         Pushes the file up to aws
 
         :param source_file:
+        :param dest_file: defaults to the file under the version
         :return:
         """
-        dest_file = str(source_file).replace(self.source_dir, self.version)
+        if dest_file is None:
+            dest_file = self._get_dest_key(source_file)
 
-        source_mime = magic.from_file(source_file, mime=True)
-        for extension in self.mime_maps:
-            if source_file.endswith(extension):
-                source_mime = self.mime_maps[extension]
+        with self.metrics.timer('mime'):
+            source_mime = self.mime_detector.get_mime(source_file)
 
-        logger.debug('The mime of %s is %s' % (source_file, source_mime))
-        logger.debug('Uploading: %s' % os.path.join(os.getcwd(), source_file))
+        upload_file, content_encoding = self.compressor.get_upload_file(source_file)
+        logger.debug('Uploading: %s' % os.path.join(os.getcwd(), upload_file))
         logger.debug('Destination: %s' % dest_file)
 
-        self.s3.meta.client.upload_file(
-            Filename=os.path.join(os.getcwd(), source_file),
+        extra_args = {
+            'ACL': 'public-read',
+            'ContentType': source_mime,
+            'CacheControl': self.cache_policy.get_cache_control(os.path.relpath(source_file, self.source_dir))
+        }
+
+        if content_encoding is not None:
+            extra_args['ContentEncoding'] = content_encoding
+
+        start_time = time.time()
+        self.transfer.call(
+            dest_file,
+            self.s3.meta.client.upload_file,
+            Filename=os.path.join(os.getcwd(), upload_file),
             Bucket=self.bucket.name,
             Key=dest_file,
-            ExtraArgs={
-                'ACL': 'public-read',
-                'ContentType': source_mime,
-                'CacheControl': 'max-age=%s' % self.cache_time
-            },
-            Callback=ProgressPercentage(os.path.join(os.getcwd(), source_file))
+            ExtraArgs=extra_args,
+            Config=self.transfer.transfer_config,
+            Callback=self.progress
         )
 
+        self.progress.file_done()
+
+        self.metrics.observe('upload', time.time() - start_time)
+        self.metrics.count('files_uploaded')
+        self.metrics.count('bytes_uploaded', os.path.getsize(upload_file))
+
 
-CMWNDeploy()
+if __name__ == '__main__':
+    CMWNDeploy()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+"""
+Shared S3 transfer settings for the deploy scripts
+
+Holds the multipart settings the ETags depend on, the worker pool the transfers
+run in and a controller that cuts how many requests run at once when S3 throttles them
+"""
+
+import sys  # Writes progress to stdout
+import threading  # Guards the limiter and counters shared by the workers
+import time  # Times the limit cuts and the progress
+from collections import deque  # Passes progress from the workers with out a lock
+
+try:
+    from boto3.exceptions import S3UploadFailedError  # Wraps errors from managed uploads
+    from boto3.s3.transfer import TransferConfig  # Controls when uploads are split into parts
+    from botocore.config import Config  # Tunes the shared connection pool
+    from botocore.exceptions import ClientError  # Raised when a request to AWS fails
+    from botocore.exceptions import ConnectionError as BotoConnectionError  # Raised when AWS cannot be reached
+    from botocore.exceptions import HTTPClientError  # Raised when a connection drops or times out
+except ImportError:
+    raise SystemExit('You are missing boto3.  run: pip install boto3')
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED  # Worker pool for the transfers
+except ImportError:
+    raise SystemExit('You are missing futures.  run: pip install futures')
+
+# Files this size or bigger are uploaded in parts, which changes the ETag S3 reports
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+# S3 needs every part but the last one to be at least this big
+MIN_MULTIPART_CHUNKSIZE = 5 * 1024 * 1024
+
+
+def set_multipart(threshold_mb, chunksize_mb):
+    """
+    Sets the size files are split in to parts at and the size of each part
+
+    :param threshold_mb:
+    :param chunksize_mb:
+    :return:
+    """
+    global MULTIPART_THRESHOLD, MULTIPART_CHUNKSIZE
+    if chunksize_mb * 1024 * 1024 < MIN_MULTIPART_CHUNKSIZE:
+        raise SystemExit('--multipart-chunksize must be at least 5MB')
+
+    if threshold_mb < 1:
+        raise SystemExit('--multipart-threshold must be at least 1MB')
+
+    MULTIPART_THRESHOLD = threshold_mb * 1024 * 1024
+    MULTIPART_CHUNKSIZE = chunksize_mb * 1024 * 1024
+
+
+def get_key_prefix(key):
+    """
+    Gets the "directory" of a key, which is what S3 partitions request rates by
+
+    :param key:
+    :return:
+    """
+    if '/' not in key.rstrip('/'):
+        return '/'
+
+    return key.rstrip('/').rsplit('/', 1)[0] + '/'
+
+
+def run_in_pool(task, task_items, jobs, action, logger, journal=None):
+    """
+    Runs the task for each item using a pool of workers
+
+    Items are only pulled from task_items as workers free up, so it can be a
+    generator that is still producing items
+
+    :param task: called with each item
+    :param task_items:
+    :param jobs: number of workers
+    :param action: what the task does, used when reporting failures
+    :param logger:
+    :param journal: journal to record each item that finishes in
+    :return: list of items that failed
+    """
+    failed_items = []
+    futures = {}
+
+    def collect(done):
+        for future in done:
+            task_item = futures.pop(future)
+            try:
+                future.result()
+            except Exception as error:
+                logger.error('Failed to %s %s: %s' % (action, task_item, error))
+                failed_items.append(task_item)
+                continue
+
+            if journal is not None:
+                journal.record(action, task_item)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for task_item in task_items:
+            futures[executor.submit(task, task_item)] = task_item
+            # Keep a second item queued for each worker so they never sit idle
+            if len(futures) >= jobs * 2:
+                collect(wait(futures, return_when=FIRST_COMPLETED).done)
+
+        collect(wait(futures).done)
+
+    return failed_items
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits how many requests run at once and backs off when S3 throttles
+
+    The limit grows by one after a full limit of requests succeed and is cut in
+    half when a request is throttled (additive increase, multiplicative decrease)
+    """
+
+    # Throttles that come back together are one signal, so the limit is only cut once in this many seconds
+    decrease_window = 1.0
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until there is room for another request
+
+        :return:
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        """
+        Frees up a request and adjusts the limit from how it went
+
+        :param throttled:
+        :return:
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled is True:
+                now = time.time()
+                if now - self._last_decrease > self.decrease_window:
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self._last_decrease = now
+            elif self.limit < self.max_limit:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+
+class TransferController(object):
+    """
+    Runs S3 requests for the deploy workers
+
+    Every HTTP request the client sends, including each part of a managed transfer,
+    takes a slot of the limiter.  botocore retries a throttled or dropped request
+    on its own with jittered backoff, throttles lower the number of requests that
+    run at once and are counted per prefix.
+    """
+
+    throttle_codes = ['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                      'TooManyRequestsException', 'ServiceUnavailable', '503']
+
+    transient_codes = ['InternalError', 'RequestTimeout', '500']
+
+    # Parts of one managed transfer sent at once, which is what boto3 uses by default
+    transfer_concurrency = 10
+
+    def __init__(self, jobs, logger, max_attempts=8):
+        self.logger = logger
+        self.max_attempts = max_attempts
+        max_requests = max(1, jobs) * self.transfer_concurrency
+        self.limiter = AdaptiveLimiter(max_requests)
+        self.requests = 0
+        self.retries = 0
+        self.throttles = {}
+        self._lock = threading.Lock()
+
+        # The standard retry mode backs off with full jitter and retries a failed part with out the rest of the file
+        self.client_config = Config(max_pool_connections=max_requests,
+                                    retries={'max_attempts': max(0, max_attempts - 1), 'mode': 'standard'})
+        self.transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                              multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                              max_concurrency=self.transfer_concurrency)
+
+    def watch(self, client):
+        """
+        Hooks the limiter in to every request the client sends
+
+        :param client: botocore client the deploy requests go through
+        :return:
+        """
+        client.meta.events.register('before-parameter-build.s3', self._remember_key)
+        client.meta.events.register('before-send.s3', self._before_send)
+        client.meta.events.register('response-received.s3', self._response_received)
+
+    def call(self, key, request, *args, **kwargs):
+        """
+        Makes a request
+
+        Bytes a failed attempt reported to the Callback of a managed transfer are
+        taken back off, so the progress does not count them when the file is tried again
+
+        :param key: key or prefix the request is for
+        :param request: called with the rest of the arguments
+        :return: what the request returns
+        """
+        sent_bytes = [0]
+        if kwargs.get('Callback') is not None:
+            callback = kwargs['Callback']
+            kwargs = dict(kwargs, Callback=self._count_sent(callback, sent_bytes))
+
+        try:
+            return request(*args, **kwargs)
+        except (ClientError, S3UploadFailedError, BotoConnectionError, HTTPClientError) as error:
+            self.logger.debug('Request for %s failed: %s' % (key, error))
+            if sent_bytes[0] != 0:
+                callback(-sent_bytes[0])
+
+            raise
+
+    def log_throttles(self):
+        """
+        Logs the prefixes S3 throttled the most
+
+        :return:
+        """
+        if len(self.throttles) < 1:
+            return
+
+        self.logger.warn('S3 throttled %s requests, %s were running at once by the end' % (
+            sum(self.throttles.values()), int(self.limiter.limit)))
+        for prefix, count in sorted(self.throttles.items(), key=lambda item: item[1], reverse=True)[:10]:
+            self.logger.warn('  %s throttled %s times' % (prefix, count))
+
+    @staticmethod
+    def _remember_key(params, context, **kwargs):
+        """
+        Keeps the key of a request where the response hook can find it
+
+        :param params:
+        :param context:
+        :return:
+        """
+        context['deploy_key'] = params.get('Key', params.get('Prefix', ''))
+
+    def _before_send(self, **kwargs):
+        """
+        Waits for a slot of the limiter before each attempt is sent
+
+        :return:
+        """
+        self.limiter.acquire()
+        with self._lock:
+            self.requests += 1
+
+    def _response_received(self, parsed_response, exception, context, **kwargs):
+        """
+        Frees the slot of an attempt and counts it when S3 throttled it
+
+        :param parsed_response:
+        :param exception:
+        :param context:
+        :return:
+        """
+        throttled = exception is None and self._has_code(parsed_response, self.throttle_codes)
+        self.limiter.release(throttled)
+        if throttled is True:
+            self._count_throttle(context.get('deploy_key', ''))
+
+        if throttled is True or isinstance(exception, (BotoConnectionError, HTTPClientError)) \
+                or (exception is None and self._has_code(parsed_response, self.transient_codes)):
+            with self._lock:
+                self.retries += 1
+
+    @staticmethod
+    def _count_sent(callback, sent_bytes):
+        """
+        Wraps a progress callback to add up the bytes one attempt reports
+
+        :param callback:
+        :param sent_bytes: list holding the bytes reported so far
+        :return:
+        """
+        def count_sent(bytes_amount):
+            sent_bytes[0] += bytes_amount
+            callback(bytes_amount)
+
+        return count_sent
+
+    def _count_throttle(self, key):
+        """
+        Counts a throttle against the prefix of the key
+
+        :param key:
+        :return:
+        """
+        prefix = get_key_prefix(key)
+        with self._lock:
+            self.throttles[prefix] = self.throttles.get(prefix, 0) + 1
+
+    @staticmethod
+    def _has_code(parsed_response, codes):
+        """
+        Checks if the response is an error for one of the codes
+
+        :param parsed_response:
+        :param codes:
+        :return:
+        """
+        if parsed_response is None:
+            return False
+
+        status = str(parsed_response.get('ResponseMetadata', {}).get('HTTPStatusCode', ''))
+        return parsed_response.get('Error', {}).get('Code') in codes or status in codes
+
+
+class TransferProgress(object):
+    """
+    Shows the progress of every transfer in flight as one line
+
+    Workers only append to a deque (which is thread safe with out a lock), a
+    background thread adds it up and draws the line.  On a terminal the line is
+    redrawn in place a few times a second, otherwise a summary line is printed
+    every so often so CI logs stay readable.
+    """
+
+    redraw_interval = 0.2
+    log_interval = 10.0
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.action = None
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.seen_bytes = 0
+        self._started_at = 0
+        self._line_length = 0
+        self._byte_updates = deque()
+        self._file_updates = deque()
+        self._total_updates = deque()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, bytes_amount):
+        """
+        Callback for boto3 as each chunk of a transfer goes through
+
+        :param bytes_amount:
+        :return:
+        """
+        self._byte_updates.append(bytes_amount)
+
+    def file_done(self, bytes_amount=0):
+        """
+        Counts a finished file along with any bytes the callback did not see
+
+        :param bytes_amount:
+        :return:
+        """
+        self._file_updates.append(bytes_amount)
+
+    def add_total(self, files, bytes_amount):
+        """
+        Adds to the totals when files are found while the transfers are running
+
+        :param files:
+        :param bytes_amount:
+        :return:
+        """
+        self._total_updates.append((files, bytes_amount))
+
+    def start(self, action, total_files, total_bytes):
+        """
+        Starts showing the progress of a batch of transfers
+
+        :param action: what is being done, like Uploaded or Linked
+        :param total_files:
+        :param total_bytes:
+        :return:
+        """
+        self.action = action
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.seen_bytes = 0
+        self._line_length = 0
+        self._started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the progress and draws the final line
+
+        :return:
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._draw()
+        if self.is_tty:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def _run(self):
+        """
+        Draws the progress until it is stopped
+
+        :return:
+        """
+        interval = self.redraw_interval if self.is_tty else self.log_interval
+        while self._stop.wait(interval) is False:
+            self._draw()
+
+    def _draw(self):
+        """
+        Adds up the updates from the workers and draws the progress line
+
+        :return:
+        """
+        # Only this thread takes from the deques, so they can not run dry part way
+        while len(self._byte_updates) > 0:
+            self.seen_bytes += self._byte_updates.popleft()
+
+        while len(self._file_updates) > 0:
+            self.seen_bytes += self._file_updates.popleft()
+            self.done_files += 1
+
+        while len(self._total_updates) > 0:
+            files, bytes_amount = self._total_updates.popleft()
+            self.total_files += files
+            self.total_bytes += bytes_amount
+
+        elapsed = max(time.time() - self._started_at, 0.001)
+        percentage = 100.0 if self.total_bytes < 1 else min(100.0, self.seen_bytes * 100.0 / self.total_bytes)
+        line = '%s %s / %s files, %.2f / %.2f MB (%.2f%%), %.2f MB/s' % (
+            self.action, self.done_files, self.total_files, self.seen_bytes / 1048576.0,
+            self.total_bytes / 1048576.0, percentage, self.seen_bytes / 1048576.0 / elapsed)
+
+        if self.is_tty:
+            # Pad over what is left of a longer line
+            self.stream.write('\r' + line.ljust(self._line_length))
+            self._line_length = len(line)
+        else:
+            self.stream.write(line + '\n')
+
+        self.stream.flush()